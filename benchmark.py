@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+'''
+Benchmarks for gitmake's hot paths, run against synthetic repositories.
+
+A bare repository stands in for the remote, and a clone of it is filled with the requested number of
+commits, branches and version tags, plus a set of release files.  The results are written as JSON, and
+can be compared against the results of an earlier run with --baseline.
+
+    python benchmark.py --tags 50000 --output results.json
+    python benchmark.py --tags 50000 --baseline results.json
+    python benchmark.py --startup-only --startup-budget 50
+'''
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import gitmake
+
+def git(cmd, cwd, input=None):
+    p = subprocess.Popen('git ' + cmd, shell=True, cwd=cwd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    output = p.communicate(input)[0]
+    if p.returncode != 0:
+        raise Exception('git %s failed' % cmd)
+    return output
+
+def make_repos(root, commits, branches, tags, files, file_size):
+    'Create a bare "remote" and a working clone of it under root.  Return the path of the working clone.'
+    remote = os.path.join(root, 'remote.git')
+    work = os.path.join(root, 'work')
+    payload = os.path.join(root, 'payload')
+    git('init -q --bare "%s"' % remote, root)
+    git('init -q "%s"' % work, root)
+    git('config user.name gitmake-benchmark', work)
+    git('config user.email benchmark@gitmake', work)
+    git('remote add origin "%s"' % remote, work)
+
+    print 'Creating %d commits' % commits
+    settings = {
+        'settings': {'build_directory': '_build', 'cache_size_mb': 0},
+        'project': {'name': 'Benchmark', 'description': 'Synthetic gitmake benchmark project'},
+        'build': {'build_command': 'cp -r "%s" payload' % payload, 'clean_command': 'rm -rf payload', 'version_file': 'version.json'},
+        'release': {'files': ['payload'], 'format': 'zip', 'filename': 'benchmark'},
+    }
+    stream = []
+    for i in range(commits):
+        blobs = {'source.txt': 'commit %d\n' % i}
+        if i == 0:
+            blobs['gitmake.json'] = json.dumps(settings, indent=4)
+            blobs['version.json'] = '{}'
+            blobs['.gitignore'] = '_build\npayload\n'
+        stream.append('commit refs/heads/master\nmark :%d\ncommitter Benchmark <benchmark@gitmake> %d +0000\ndata 9\ncommit %02d\n' % (i+1, 1000000000 + i, i % 100))
+        if i:
+            stream.append('from :%d\n' % i)
+        for name, data in sorted(blobs.items()):
+            stream.append('M 100644 inline %s\ndata %d\n%s\n' % (name, len(data), data))
+    git('fast-import --quiet', work, input=''.join(stream))
+    marks = git('rev-list --reverse master', work).split()
+
+    print 'Creating %d branches and %d tags' % (branches, tags)
+    names = ['master'] + ['branch%d' % i for i in range(1, branches)]
+    updates = ['create refs/heads/%s %s\n' % (name, random.choice(marks)) for name in names[1:]]
+    for i in range(tags):
+        updates.append('create refs/tags/v%d.%d.%d-%s %s\n' % (i // 10000, (i // 100) % 100, i % 100, names[i % len(names)], random.choice(marks)))
+    git('update-ref --stdin', work, input=''.join(updates))
+    git('pack-refs --all', work)
+    git('checkout -q master', work)
+    git('push -q origin --all', work)
+    git('push -q origin --tags', work)
+
+    print 'Creating %d release files of %dkB' % (files, file_size)
+    os.makedirs(payload)
+    for i in range(files):
+        # Half random and half text, so that the compression of the bundle formats can be compared
+        with open(os.path.join(payload, 'file%d.bin' % i), 'wb') as fp:
+            fp.write(os.urandom(file_size * 512))
+            text = ''.join('%08x %s\n' % (random.randrange(1 << 32), random.choice(names)) for j in range(file_size * 16))
+            fp.write(text[:file_size * 512])
+    return work
+
+@contextmanager
+def quiet():
+    'Send everything written to stdout and stderr (including by child processes) to /dev/null'
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = os.dup(1), os.dup(2)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        for fd in saved + (devnull,):
+            os.close(fd)
+
+def reset_gitmake_state(drop_index=False):
+    'Forget everything gitmake has cached in memory, and optionally its on-disk version index'
+    gitmake.repos_state.clear()
+    if drop_index:
+        path = os.path.join('.git', 'gitmake', 'versions.json')
+        if os.path.exists(path):
+            os.remove(path)
+
+def arguments(**kwargs):
+    args = argparse.Namespace(major=False, minor=False, patch=True, remote=True, confirm=False, release=False,
+                              message='Benchmark tag', cache=False, checkout=None, tag=None, jobs=None,
+                              trace=None, profile=False, pipeline=False, resume=False)
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+    return args
+
+def measure(name, func, repeat, setup=None):
+    'Time func, returning the best wall time of repeat runs and the number of git processes it spawned'
+    best = None
+    for i in range(repeat):
+        if setup:
+            setup(i)
+        count = gitmake.git_process_count
+        with quiet():
+            start = time.time()
+            try:
+                func(i)
+            except SystemExit:
+                pass
+            elapsed = time.time() - start
+        processes = gitmake.git_process_count - count
+        best = elapsed if best is None else min(best, elapsed)
+    print '  %-36s %9.4fs %6d git processes' % (name, best, processes)
+    return {'seconds': best, 'git_processes': processes}
+
+def measure_startup(name, argv, runs):
+    'Time a complete gitmake run in a new process, returning the median wall time of runs'
+    script = os.path.abspath(gitmake.__file__).replace('.pyc', '.py')
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for i in range(runs):
+            start = time.time()
+            subprocess.call([sys.executable, script] + argv, stdout=devnull, stderr=devnull)
+            times.append(time.time() - start)
+    median = sorted(times)[len(times) // 2]
+    print '  %-36s %9.4fs' % (name, median)
+    return {'seconds': median}
+
+def run_benchmarks(work, repeat):
+    settings = json.load(open(os.path.join(work, 'gitmake.json')))
+    results = {}
+    with gitmake.cd(work):
+        results['get_tags_cold'] = measure('GitRepos.get_tags (no index)', lambda i: gitmake.GitRepos().get_tags(), repeat,
+                                           setup=lambda i: reset_gitmake_state(drop_index=True))
+        results['get_tags'] = measure('GitRepos.get_tags', lambda i: gitmake.GitRepos().get_tags(), repeat,
+                                      setup=lambda i: reset_gitmake_state())
+        results['get_branches'] = measure('GitRepos.get_branches', lambda i: gitmake.GitRepos().get_branches(), repeat,
+                                          setup=lambda i: reset_gitmake_state())
+        results['get_version_increment'] = measure('do_get_version_increment_here', lambda i: gitmake.do_get_version_increment_here(arguments()), repeat,
+                                                   setup=lambda i: reset_gitmake_state())
+
+        subprocess.check_call(settings['build']['build_command'], shell=True)
+        for format in sorted(gitmake.BUNDLE_FORMATS):
+            format_settings = dict(settings, release=dict(settings['release'], format=format))
+            sizes = []
+            def collect(i):
+                bundle = gitmake.do_collect_release_data_here(arguments(), format_settings)
+                sizes.append(os.path.getsize(bundle))
+                os.remove(bundle)
+            name = 'collect_release_data' + ('' if format == 'zip' else '_' + format.replace('.', '_'))
+            results[name] = measure('do_collect_release_data_here %s' % format, collect, repeat)
+            total = sum(os.path.getsize(path) for path, arcname in gitmake.expand_release_files(settings['release']['files']))
+            results[name]['ratio'] = float(total) / min(sizes)
+            print '  %-36s %9.2fx' % ('compression ratio of %s' % format, results[name]['ratio'])
+
+        def tag_here(i):
+            git('tag -a v999.%d.0-master -m "Benchmark release"' % i, '.')
+            git('push -q origin v999.%d.0-master' % i, '.')
+            reset_gitmake_state()
+        def release(i):
+            gitmake.do_release(arguments(), settings, gitmake.VersionInfo(999, i, 0, 'master'))
+            gitmake.do_push_queued()
+        results['release'] = measure('do_release', release, repeat, setup=tag_here)
+        def tag(i):
+            gitmake.command_tag(arguments(remote=False), settings)
+            gitmake.do_push_queued()
+        results['tag_noremote'] = measure('command_tag --noremote', tag, repeat, setup=lambda i: reset_gitmake_state())
+    return results
+
+def run_startup_benchmarks(work, runs):
+    results = {}
+    with gitmake.cd(work):
+        results['startup_version'] = measure_startup('gitmake.py --version', ['--version'], runs)
+        results['startup_versions'] = measure_startup('gitmake.py versions --latest', ['versions', '--latest'], runs)
+    return results
+
+def run_tag_contention(root, processes):
+    '''
+    Tag master from the given number of clones at once, as concurrent CI jobs would, and check that every process
+    got its own version and that no versions were skipped.  Return the wall time of the whole run.
+    '''
+    script = os.path.abspath(gitmake.__file__).replace('.pyc', '.py')
+    remote = os.path.join(root, 'remote.git')
+    before = set(git('tag', remote).split())
+    clones = []
+    for i in range(processes):
+        clone = os.path.join(root, 'contention%d' % i)
+        git('clone -q "%s" "%s"' % (remote, clone), root)
+        clones.append(clone)
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        children = [subprocess.Popen([sys.executable, script, 'tag', '--patch', '--noconfirm', '--nodaemon'],
+                                     cwd=dir, stdout=devnull, stderr=devnull) for dir in clones]
+        failed = sum(1 for child in children if child.wait() != 0)
+        elapsed = time.time() - start
+    new = sorted(gitmake.VersionInfo.from_string(tag) for tag in set(git('tag', remote).split()) - before)
+    ok = not failed and len(new) == processes and all(b == a.rev_patch() for a, b in zip(new, new[1:]))
+    print '  %-36s %9.4fs %6d tags%s' % ('tag from %d clones at once' % processes, elapsed, len(new), '' if ok else '  FAILED')
+    return {'seconds': elapsed, 'ok': ok}
+
+def run_branch_contention(root, processes, rounds=3):
+    '''
+    Tag a different branch from each of the given number of worktrees of one repository at once, rounds times each, so
+    that the processes share .git/gitmake.  Check that every run succeeded, that each branch got its versions in order
+    with one tag commit each, and that the version index lists them all.  Return the wall time of the whole run.
+    '''
+    script = os.path.abspath(gitmake.__file__).replace('.pyc', '.py')
+    repos = os.path.join(root, 'branch-contention')
+    git('clone -q "%s" "%s"' % (os.path.join(root, 'remote.git'), repos), root)
+    branches = ['contention-%d' % i for i in range(processes)]
+    for branch in branches:
+        git('worktree add -q -b %s "%s" HEAD' % (branch, os.path.join(root, branch)), repos)
+    base = int(git('rev-list --count HEAD', repos))
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        command = '; '.join(['"%s" "%s" tag --patch --noconfirm --nodaemon' % (sys.executable, script)] * rounds)
+        children = [subprocess.Popen('set -e; ' + command, shell=True, cwd=os.path.join(root, branch), stdout=devnull, stderr=devnull)
+                    for branch in branches]
+        failed = sum(1 for child in children if child.wait() != 0)
+        elapsed = time.time() - start
+    ok = not failed
+    with gitmake.cd(repos):
+        gitmake.repos_state.clear()
+        local = gitmake.GitRepos()
+        for branch in branches:
+            expected = ['v0.0.%d-%s' % (i + 1, branch) for i in range(rounds)]
+            ok = ok and git('tag -l "v*-%s"' % branch, repos).split() == expected
+            ok = ok and [v.tag for v in local.get_tags(branch)] == expected
+            ok = ok and int(git('rev-list --count %s' % branch, repos)) == base + rounds
+    print '  %-36s %9.4fs %6d tags%s' % ('tag %d branches of one repos at once' % processes, elapsed, processes * rounds, '' if ok else '  FAILED')
+    return {'seconds': elapsed, 'ok': ok}
+
+def write_payload_file(path, size):
+    'Write a file that is half random and half text, like the synthetic payload'
+    with open(path, 'wb') as fp:
+        fp.write(os.urandom(size // 2))
+        fp.write(''.join('%08x line\n' % random.randrange(1 << 32) for j in range(size // 28 + 1))[:size - size // 2])
+
+def pack_size(repos):
+    'Return the size in bytes of the packed objects of the repos'
+    stats = dict(line.split(': ') for line in git('count-objects -v', repos).splitlines())
+    return int(stats['size-pack']) * 1024
+
+def run_storage_benchmark(root, releases, files, file_size, repeat):
+    '''
+    Release the synthetic payload the given number of times with each release storage mode, changing one file
+    completely and appending to another between releases.  Return the size of the remote after a gc, the best
+    time to clone it, and the time to read one file from every release with the releases command, against
+    checking out the release branch, for each mode.
+    '''
+    results = {}
+    for storage in gitmake.RELEASE_STORAGE_MODES:
+        random.seed(releases)
+        remote = os.path.join(root, 'storage-%s.git' % storage)
+        work = os.path.join(root, 'storage-%s' % storage)
+        git('init -q --bare "%s"' % remote, root)
+        git('init -q "%s"' % work, root)
+        git('remote add origin "%s"' % remote, work)
+        payload = os.path.join(work, 'payload')
+        os.makedirs(payload)
+        for i in range(files):
+            write_payload_file(os.path.join(payload, 'file%d.bin' % i), file_size * 1024)
+        settings = {'settings': {}, 'release': {'files': [payload], 'format': 'zip', 'filename': 'benchmark', 'storage': storage}}
+        start = time.time()
+        with gitmake.cd(work):
+            with quiet():
+                for i in range(releases):
+                    write_payload_file(os.path.join(payload, 'file%d.bin' % (i % files)), file_size * 1024)
+                    with open(os.path.join(payload, 'file%d.bin' % ((i + 1) % files)), 'ab') as fp:
+                        fp.write('release %d\n' % i)
+                    bundle = gitmake.do_collect_release_data_here(arguments(), settings, version=gitmake.VersionInfo(1, 0, i, 'master'))
+                    gitmake.do_commit_release_here(arguments(), settings, gitmake.VersionInfo(1, 0, i, 'master'), bundle)
+                gitmake.GitRepos(remote=True).push(gitmake.RELEASE_BRANCH_NAME)
+                gitmake.do_push_queued()
+        release_time = time.time() - start
+        with gitmake.cd(work):
+            start = time.time()
+            repos = gitmake.GitRepos()
+            index = gitmake.ReleaseIndex(repos, repos.resolve('refs/heads/%s' % gitmake.RELEASE_BRANCH_NAME))
+            with gitmake.ObjectReader() as reader:
+                for release in index.releases.values():
+                    gitmake.open_release_member(reader, release, 'payload/file0.bin')[0].read()
+            get_time = time.time() - start
+        checkout = os.path.join(root, 'storage-%s-checkout' % storage)
+        start = time.time()
+        git('clone -q --branch %s "%s" "%s"' % (gitmake.RELEASE_BRANCH_NAME, work, checkout), root)
+        for release in index.releases.values():
+            if release['storage'] == 'tree':
+                open(os.path.join(checkout, release['name'], 'payload', 'file0.bin'), 'rb').read()
+            else:
+                zipfile.ZipFile(os.path.join(checkout, release['name'])).read('payload/file0.bin')
+        checkout_time = time.time() - start
+        git('gc -q', remote)
+        clone = os.path.join(root, 'storage-%s-clone' % storage)
+        best = None
+        for i in range(repeat):
+            shutil.rmtree(clone, ignore_errors=True)
+            start = time.time()
+            git('clone -q --bare --no-local "%s" "%s"' % (remote, clone), root)
+            best = time.time() - start if best is None else min(best, time.time() - start)
+        results['storage_%s' % storage] = {'seconds': best, 'repos_bytes': pack_size(remote), 'release_seconds': release_time,
+                                           'get_seconds': get_time, 'checkout_seconds': checkout_time}
+        print '  %-36s %9.4fs clone %9.2fMB repos %8.2fs to release' % ('%d releases stored as %s' % (releases, storage), best, pack_size(remote) / 1e6, release_time)
+        print '  %-36s %9.4fs get %9.4fs checkout' % ('one file of every release', get_time, checkout_time)
+    return results
+
+def compare(results, baseline, threshold):
+    'Print the change against the baseline results.  Return True if nothing got slower by more than threshold.'
+    ok = True
+    print 'Comparison with baseline:'
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        old, new = baseline[name]['seconds'], results[name]['seconds']
+        change = (new - old) / old if old else 0.0
+        regression = change > threshold
+        ok = ok and not regression
+        print '  %-24s %9.4fs -> %9.4fs %+7.1f%%%s' % (name, old, new, change*100, '  REGRESSION' if regression else '')
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark gitmake against synthetic repositories')
+    parser.add_argument('--commits', type=int, default=200, help='Number of commits on master')
+    parser.add_argument('--branches', type=int, default=10, help='Number of branches')
+    parser.add_argument('--tags', type=int, default=1000, help='Number of version tags, spread over the branches')
+    parser.add_argument('--files', type=int, default=20, help='Number of release files')
+    parser.add_argument('--file-size', type=int, default=256, metavar='KB', help='Size of each release file in kB')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of each benchmark.  The best time is reported.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic repository layout')
+    parser.add_argument('--dir', type=str, help='Where to create the synthetic repositories (a temporary directory by default, deleted afterwards)')
+    parser.add_argument('--output', '-o', type=str, metavar='FILE', help='Write the results as JSON to FILE')
+    parser.add_argument('--baseline', type=str, metavar='FILE', help='Compare against the results in FILE and fail on regressions')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Slowdown (as a fraction) that counts as a regression')
+    parser.add_argument('--startup-runs', type=int, default=20, help='Runs of each startup benchmark.  The median time is reported.')
+    parser.add_argument('--startup-budget', type=float, default=50, metavar='MS', help='Fail if a trivial gitmake command takes longer than this')
+    parser.add_argument('--tag-processes', type=int, default=8, metavar='N', help='Number of processes tagging at once in the contention benchmarks: on the same branch from separate clones, and on separate branches of one repository (0 to skip them)')
+    parser.add_argument('--storage-releases', type=int, default=0, metavar='N', help='Compare the release storage modes by making N releases with each (0 to skip)')
+    parser.add_argument('--startup-only', action='store_true', default=False, help='Only run the startup benchmarks')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    # Commits are made in fresh clones, which don't have the identity configured in the synthetic repos
+    for var, value in (('NAME', 'gitmake-benchmark'), ('EMAIL', 'benchmark@gitmake')):
+        os.environ.setdefault('GIT_AUTHOR_' + var, value)
+        os.environ.setdefault('GIT_COMMITTER_' + var, value)
+    params = dict((key, getattr(args, key)) for key in ('commits', 'branches', 'tags', 'files', 'file_size', 'repeat', 'seed', 'startup_runs', 'tag_processes', 'storage_releases'))
+    root = os.path.abspath(args.dir) if args.dir else tempfile.mkdtemp(prefix='gitmake-benchmark-')
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    try:
+        work = make_repos(root, args.commits, args.branches, args.tags, args.files, args.file_size)
+        print 'Running benchmarks'
+        results = {} if args.startup_only else run_benchmarks(work, args.repeat)
+        if args.tag_processes and not args.startup_only:
+            results['tag_contention'] = run_tag_contention(root, args.tag_processes)
+            results['branch_contention'] = run_branch_contention(root, args.tag_processes)
+        if args.storage_releases and not args.startup_only:
+            results.update(run_storage_benchmark(root, args.storage_releases, args.files, args.file_size, args.repeat))
+        results.update(run_startup_benchmarks(work, args.startup_runs))
+    finally:
+        if not args.dir:
+            shutil.rmtree(root, ignore_errors=True)
+
+    ok = results.get('tag_contention', {}).get('ok', True) and results.get('branch_contention', {}).get('ok', True)
+    for name in ('startup_version', 'startup_versions'):
+        if results[name]['seconds'] * 1000 > args.startup_budget:
+            print '%s took %0.1fms, over the startup budget of %0.1fms' % (name, results[name]['seconds'] * 1000, args.startup_budget)
+            ok = False
+
+    report = {'gitmake': gitmake.version_string, 'params': params, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=4, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        if baseline.get('params') != params:
+            print 'Warning: the baseline was run with different parameters: %s' % baseline.get('params')
+        ok = compare(results, baseline['results'], args.threshold) and ok
+    if not ok:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,14 @@
 #!/usr/bin/env python
-import urllib2
 from contextlib import contextmanager
 import time
 import argparse
 import json
 import os
 import sys
-import subprocess
 import re
-import string
-import zipfile
-import StringIO
+import functools
+import collections
+import bisect
 
 # Version of this script
 version_info = (0,0,0,'dev')
@@ -20,25 +18,80 @@ VERSION_FILENAME = 'version.json'
 SETTINGS_FILENAME = 'gitmake.json'
 GITMAKE_MSG = '[GITMAKE] '
 RELEASE_BRANCH_NAME = 'release'
+CHECKOUT_MODES = ('reference', 'worktree', 'clone', 'shallow')
+MANIFEST_FILENAME = 'MANIFEST.json'
+VERSION_RE = re.compile(r'v(\d+)\.(\d+)\.(\d+)-([\w.\-/]+)$')
+VERSION_PATTERN_RE = re.compile(r'v?(\d+|[x*])(?:\.(\d+|[x*]))?(?:\.(\d+|[x*]))?-([\w.\-/]+)$')
+HASH_CHUNK_SIZE = 1024*1024
+COMPRESS_CHUNK_SIZE = 1024*1024
+BUNDLE_FORMATS = {'zip':'.zip', 'tar':'.tar', 'tar.gz':'.tar.gz', 'tar.xz':'.tar.xz'}
+DEFAULT_COMPRESSION_LEVEL = 6
+RELEASE_STORAGE_MODES = ('bundle', 'tree')
+VERSION_TIMESTAMP_MODES = ('now', 'commit')
+
+C_VERSION_TEMPLATE = '#ifndef __VERSION_H__\n#define __VERSION_H__\n#define VERSION_MAJOR $major\n#define VERSION_MINOR $minor\n#define VERSION_PATCH $patch\n#define VERSION_BRANCH $branch\n#define VERSION_TIMESTAMP $timestamp\n#endif'
+VERSION_TEMPLATES = {
+    'h' : C_VERSION_TEMPLATE,
+    'hpp' : C_VERSION_TEMPLATE,
+    'json' : '{"major":$major,"minor":$minor,"patch":$patch,"branch":"$branch","timestamp":$timestamp}',
+    'py' : 'major = $major\nminor=$minor\npatch=$patch\nbranch="$branch"\ntimestamp=$timestamp',
+    'cmake' : 'set(VERSION_MAJOR $major)\nset(VERSION_MINOR $minor)\nset(VERSION_PATCH $patch)\nset(VERSION_BRANCH "$branch")\nset(VERSION_TIMESTAMP $timestamp)\n',
+    'mk' : 'VERSION_MAJOR := $major\nVERSION_MINOR := $minor\nVERSION_PATCH := $patch\nVERSION_BRANCH := $branch\nVERSION_TIMESTAMP := $timestamp\n',
+}
+DEFAULT_CACHE_SIZE_MB = 2048
+DO_TAIL_LINES = 1000
+BUILD_LOGS_KEPT = 10
+TRACE_NAME_LENGTH = 80
+PROFILE_ROWS = 30
+TAG_ATTEMPTS = 50
+OBJECT_SPOOL_SIZE = 32*1024*1024
+RELEASE_NAME_RE = re.compile(r'-(v\d+\.\d+\.\d+-[\w.\-]+?)(%s)$' % '|'.join(re.escape(ext) for ext in sorted(BUNDLE_FORMATS.values(), key=len, reverse=True)))
 UPDATE_URL = 'https://github.com/ryansturmer/gitmake/blob/release/gitmake-$tag.zip?raw=true'
 
-try:
-    import colorama
-    colorama.init()
-    def message(s):
-        print str(colorama.Fore.CYAN + GITMAKE_MSG + str(s) + colorama.Fore.RESET)
-    def error(s):
-        print str(colorama.Fore.CYAN + GITMAKE_MSG + colorama.Fore.RED + str(s) + colorama.Fore.RESET)
-    def command(s):
-        print str(colorama.Fore.GREEN + str(s) + colorama.Fore.RESET)
-except:
-    def message(s):
-        print GITMAKE_MSG + str(s)
-    def error(s):
-        return message(s)
-    def command(s):
-        return message(s)
-    error('No colorama support.  Install colorama for console coloring.')
+# Set by commands whose output is meant for other programs, to suppress progress messages (but not errors)
+quiet = False
+
+# Console colors, set up on first use: colorama.Fore, or False when colorama isn't installed
+colors = None
+
+def console_colors():
+    global colors
+    if colors is None:
+        try:
+            import colorama
+            colorama.init()
+            colors = colorama.Fore
+        except ImportError:
+            colors = False
+            message('No colorama support.  Install colorama for console coloring.')
+    return colors
+
+def message(s):
+    if not quiet:
+        c = console_colors()
+        print str(c.CYAN + GITMAKE_MSG + str(s) + c.RESET) if c else GITMAKE_MSG + str(s)
+
+def error(s):
+    c = console_colors()
+    print str(c.CYAN + GITMAKE_MSG + c.RED + str(s) + c.RESET) if c else GITMAKE_MSG + str(s)
+
+def command(s):
+    if not quiet:
+        c = console_colors()
+        print str(c.GREEN + str(s) + c.RESET) if c else GITMAKE_MSG + str(s)
+
+@contextmanager
+def atomic_write(path, mode='w'):
+    'Open a temporary file next to path for writing, and move it over path once the block completes (or remove it if the block fails)'
+    tmp = '%s.tmp-%d' % (path, os.getpid())
+    try:
+        with open(tmp, mode) as fp:
+            yield fp
+        os.rename(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
 
 @contextmanager
 def cd(path):
@@ -53,17 +106,104 @@ def cd(path):
         message("Changing to directory %s" % old_path)
         os.chdir(old_path)
 
+class Tracer(object):
+    '''
+    Records timed spans of gitmake's work for --trace and --profile.  Each span has the wall time, the CPU time of
+    gitmake itself and of the child processes it waited for, and the number of bytes gitmake wrote (where the OS reports it).
+    '''
+    def __init__(self):
+        self.spans = []
+        self.origin = time.time()
+
+    @staticmethod
+    def bytes_written():
+        try:
+            with open('/proc/self/io') as fp:
+                for line in fp:
+                    if line.startswith('wchar:'):
+                        return int(line.split()[1])
+        except IOError:
+            pass
+        return 0
+
+    @contextmanager
+    def span(self, name, category):
+        start, times, written = time.time(), os.times(), self.bytes_written()
+        try:
+            yield
+        finally:
+            end, end_times = time.time(), os.times()
+            self.spans.append({'name':name, 'cat':category, 'pid':os.getpid(),
+                               'start':start - self.origin, 'wall':end - start,
+                               'cpu':(end_times[0] + end_times[1]) - (times[0] + times[1]),
+                               'child':(end_times[2] + end_times[3]) - (times[2] + times[3]),
+                               'bytes':self.bytes_written() - written})
+
+    def write(self, path):
+        'Write the spans to path, as JSON lines if it ends with .jsonl and as a Chrome trace otherwise'
+        if path.endswith('.jsonl'):
+            with open(path, 'w') as fp:
+                for span in self.spans:
+                    fp.write(json.dumps(span) + '\n')
+            return
+        events = [{'name':span['name'], 'cat':span['cat'], 'ph':'X', 'pid':span['pid'], 'tid':span['pid'],
+                   'ts':int(span['start']*1e6), 'dur':int(span['wall']*1e6),
+                   'args':{'cpu_ms':span['cpu']*1e3, 'child_ms':span['child']*1e3, 'bytes_written':span['bytes']}} for span in self.spans]
+        with open(path, 'w') as fp:
+            json.dump({'traceEvents':events, 'displayTimeUnit':'ms'}, fp)
+
+    def show_profile(self):
+        'Print the total time spent in each kind of span, slowest first'
+        totals = {}
+        for span in self.spans:
+            total = totals.setdefault((span['cat'], span['name']), [0, 0.0, 0.0, 0.0, 0])
+            total[0] += 1
+            for i, key in ((1, 'wall'), (2, 'cpu'), (3, 'child'), (4, 'bytes')):
+                total[i] += span[key]
+        message('%-44s %6s %9s %9s %9s %10s' % ('Span', 'Calls', 'Wall(s)', 'CPU(s)', 'Child(s)', 'Written'))
+        for (cat, name), (calls, wall, cpu, child, written) in sorted(totals.items(), key=lambda x: -x[1][1])[:PROFILE_ROWS]:
+            message('%-44s %6d %9.3f %9.3f %9.3f %10d' % (('%s:%s' % (cat, name))[:44], calls, wall, cpu, child, written))
+
+# The Tracer for this run, if --trace or --profile was given
+tracer = None
+
+@contextmanager
+def trace_span(name, category):
+    if tracer is None:
+        yield
+    else:
+        with tracer.span(name, category):
+            yield
+
+def traced(category):
+    'Decorator that records each call of the function as a span of the given category when tracing'
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if tracer is None:
+                return func(*args, **kwargs)
+            with tracer.span(func.__name__, category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
 class VersionInfo(object):
+    'A version number.  Versions sort by branch, then major, minor and patch level, using the precomputed key tuple.'
+    __slots__ = ('major', 'minor', 'patch', 'branch', 'key')
     def __init__(self,major=0,minor=0,patch=0,branch='dev'):
         self.major = int(major)
         self.minor = int(minor)
         self.patch = int(patch)
         self.branch = str(branch)
+        self.key = (self.branch, self.major, self.minor, self.patch)
     def dict(self):
         return {'major':self.major, 'minor':self.minor, 'patch':self.patch, 'branch':self.branch }
     @staticmethod
+    def from_key(key):
+        return VersionInfo(key[1], key[2], key[3], key[0])
+    @staticmethod
     def from_string(s):
-        m= re.match(r'v(\d+)\.(\d+)\.(\d+)-(\w+)', s)
+        m = VERSION_RE.match(s)
         if m:
             return VersionInfo(*m.groups())
         else:
@@ -74,17 +214,24 @@ class VersionInfo(object):
         return VersionInfo(self.major,self.minor+1,0,branch or self.branch)    
     def rev_patch(self, branch=None):
         return VersionInfo(self.major,self.minor,self.patch+1,branch or self.branch)   
-    def __cmp__(self, x):
+    def _other_key(self, x):
         if not isinstance(x, VersionInfo):
             raise TypeError('Cannot compare VersionInfo and "%s" object' % str(type(x)))
-        if self.tag == x.tag:
-            return 0
-        if x.branch != self.branch:
-            return cmp(self.branch, x.branch)
-        for a,b in ((self.major, x.major),(self.minor, x.minor), (self.patch, x.patch)):
-            c = cmp(a,b)
-            if c != 0:
-                return c
+        return x.key
+    def __eq__(self, x):
+        return isinstance(x, VersionInfo) and self.key == x.key
+    def __ne__(self, x):
+        return not self == x
+    def __lt__(self, x):
+        return self.key < self._other_key(x)
+    def __le__(self, x):
+        return self.key <= self._other_key(x)
+    def __gt__(self, x):
+        return self.key > self._other_key(x)
+    def __ge__(self, x):
+        return self.key >= self._other_key(x)
+    def __hash__(self):
+        return hash(self.key)
     @property
     def tag(self):
         return 'v%d.%d.%d-%s' % (self.major, self.minor, self.patch, self.branch)
@@ -93,103 +240,888 @@ class VersionInfo(object):
     def __repr__(self):
         return str(self)
 
+class VersionSet(object):
+    '''
+    Sorted collection of versions, stored as key tuples (branch, major, minor, patch) so that
+    lookups, prefix queries ("latest 1.x on master") and range queries are bisections.
+    '''
+    def __init__(self, versions=(), sorted_keys=None):
+        self.keys = sorted_keys if sorted_keys is not None else sorted(v.key for v in versions)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        return (VersionInfo.from_key(key) for key in self.keys)
+
+    def __contains__(self, version):
+        i = bisect.bisect_left(self.keys, version.key)
+        return i < len(self.keys) and self.keys[i] == version.key
+
+    def add(self, version):
+        if version not in self:
+            bisect.insort(self.keys, version.key)
+
+    def _prefix_bounds(self, branch, prefix):
+        'Return the slice of keys on the branch whose version numbers start with prefix'
+        low = (branch,) + tuple(prefix)
+        high = (branch,) + tuple(prefix[:-1]) + (prefix[-1] + 1,) if prefix else (branch + '\0',)
+        return bisect.bisect_left(self.keys, low), bisect.bisect_left(self.keys, high)
+
+    def matching(self, branch, prefix=()):
+        'Return the versions on the branch whose (major, minor, patch) starts with prefix, e.g. (1,) for all 1.x versions'
+        i, j = self._prefix_bounds(branch, prefix)
+        return [VersionInfo.from_key(key) for key in self.keys[i:j]]
+
+    def latest(self, branch, prefix=()):
+        'Return the latest version on the branch that starts with prefix, or None'
+        i, j = self._prefix_bounds(branch, prefix)
+        return VersionInfo.from_key(self.keys[j-1]) if j > i else None
+
+    def between(self, low, high):
+        'Return the versions from low to high, inclusive'
+        i = bisect.bisect_left(self.keys, low.key)
+        j = bisect.bisect_right(self.keys, high.key)
+        return [VersionInfo.from_key(key) for key in self.keys[i:j]]
+
+    def next_patch(self, branch, major, minor):
+        'Return the first unused patch version of major.minor on the branch'
+        latest = self.latest(branch, (major, minor))
+        return latest.rev_patch() if latest else VersionInfo(major, minor, 0, branch)
+
+    def select(self, spec, branch=None):
+        '''
+        Return the versions selected by a range spec, which is one of:
+          A..B          versions from tag A to tag B, inclusive
+          v1.x-master   versions on master starting with the given numbers (x or * is a wildcard)
+        With no spec, all versions (on the branch, if one is given) are returned.
+        '''
+        if not spec:
+            return self.matching(branch) if branch else list(self)
+        if '..' in spec:
+            low, high = spec.split('..', 1)
+            return self.between(VersionInfo.from_string(low), VersionInfo.from_string(high))
+        branch, prefix = parse_version_pattern(spec)
+        return self.matching(branch, prefix)
+
+def parse_version_pattern(spec):
+    'Parse a version pattern like v1.x-master or v1.2.*-master.  Return a tuple: (branch, prefix of version numbers)'
+    m = VERSION_PATTERN_RE.match(spec)
+    if not m:
+        raise ValueError('Invalid version pattern: %s' % spec)
+    prefix = []
+    for number in m.groups()[:3]:
+        if number is None or number in 'x*':
+            break
+        prefix.append(int(number))
+    return m.group(4), tuple(prefix)
+
 gitmake_version = VersionInfo(*version_info)
 
+def find_git_dir(path):
+    'Return the git directory of the repos containing path, or None if path is not in a repos'
+    path = os.path.abspath(path)
+    while True:
+        candidate = os.path.join(path, '.git')
+        if os.path.isdir(candidate):
+            return candidate
+        if os.path.isfile(candidate):
+            with open(candidate) as fp:
+                line = fp.read().strip()
+            if line.startswith('gitdir:'):
+                candidate = os.path.normpath(os.path.join(path, line[len('gitdir:'):].strip()))
+                # Worktrees keep their refs in the common directory of the main repos
+                commondir = os.path.join(candidate, 'commondir')
+                if os.path.isfile(commondir):
+                    with open(commondir) as fp:
+                        candidate = os.path.normpath(os.path.join(candidate, fp.read().strip()))
+                return candidate
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+class VersionIndex(object):
+    '''
+    Per-branch sorted index of the version tags in a repos, persisted in .git/gitmake/versions.json.
+    The index is stamped with the modification times of the tag refs, and is rebuilt from the
+    list of tags only when they have changed behind gitmake's back.  Tags created by gitmake are
+    added incrementally.
+    '''
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        self.path = os.path.join(git_dir, 'gitmake', 'versions.json') if git_dir else None
+        self.stamp = None
+        self.branches = {}
+
+    def fingerprint(self):
+        '''
+        Return a stamp that changes whenever a tag ref is added, removed or packed: the packed-refs file, and every directory
+        under refs/tags (a loose tag in a subdirectory, such as v1.0.0-feature/x, only changes the mtime of its own directory)
+        '''
+        if not self.git_dir:
+            return None
+        retval = []
+        try:
+            st = os.stat(os.path.join(self.git_dir, 'packed-refs'))
+            retval.append([repr(st.st_mtime), st.st_size])
+        except OSError:
+            retval.append(None)
+        tags = os.path.join(self.git_dir, 'refs', 'tags')
+        for dir, dirs, files in os.walk(tags):
+            dirs.sort()
+            try:
+                retval.append([os.path.relpath(dir, tags), repr(os.stat(dir).st_mtime)])
+            except OSError:
+                # Removed while walking
+                retval.append([os.path.relpath(dir, tags), None])
+        return retval
+
+    def is_current(self):
+        return self.stamp is not None and self.stamp == self.fingerprint()
+
+    def load(self):
+        'Load the index from disk.  Return True if it was loaded and is still current.'
+        if not self.path:
+            return False
+        try:
+            with open(self.path) as fp:
+                data = json.load(fp)
+            self.stamp = data['stamp']
+            self.branches = dict((branch, [tuple(v) for v in versions]) for branch, versions in data['branches'].items())
+        except Exception:
+            self.stamp = None
+            self.branches = {}
+        return self.is_current()
+
+    def save(self):
+        if not self.path:
+            return
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            with atomic_write(self.path) as fp:
+                json.dump({'stamp':self.stamp, 'branches':self.branches}, fp)
+        except (IOError, OSError), e:
+            error("Couldn't save version index: %s" % e)
+
+    @contextmanager
+    def locked(self):
+        'Hold the lock on the index while the block runs.  Processes creating tags hold it, so that none of the tags is left out.'
+        if not self.path:
+            yield
+            return
+        with file_lock(self.path + '.lock', 'updating the version index'):
+            yield
+
+    def rebuild(self, tags, stamp):
+        '''
+        Rebuild the index from a list of tag names, listed after taking the stamp.  A tag created after the stamp was taken
+        changes the fingerprint, so the index is rebuilt again instead of missing it.
+        '''
+        message('Rebuilding version index')
+        self.branches = {}
+        for tag in tags:
+            try:
+                version = VersionInfo.from_string(tag)
+            except ValueError:
+                continue
+            self.branches.setdefault(version.branch, []).append((version.major, version.minor, version.patch))
+        for versions in self.branches.values():
+            versions.sort()
+        self.stamp = stamp
+        with self.locked():
+            self.save()
+
+    def add(self, version):
+        '''
+        Add a version to the index, after its tag has been created, and take the new fingerprint as the stamp.  Only valid with
+        the index locked, and loaded and current just before the tag was created (see GitRepos.tag).
+        '''
+        versions = self.branches.setdefault(version.branch, [])
+        key = (version.major, version.minor, version.patch)
+        i = bisect.bisect_left(versions, key)
+        if i == len(versions) or versions[i] != key:
+            versions.insert(i, key)
+        self.stamp = self.fingerprint()
+        self.save()
+
+    def latest(self, branch):
+        'Return the latest version on the branch, or None if there are no versions'
+        versions = self.branches.get(branch)
+        return VersionInfo(*versions[-1], branch=branch) if versions else None
+
+    def contains(self, version):
+        versions = self.branches.get(version.branch, [])
+        key = (version.major, version.minor, version.patch)
+        i = bisect.bisect_left(versions, key)
+        return i < len(versions) and versions[i] == key
+
+    def range(self, branch, low=None, high=None):
+        'Return the versions on the branch from low to high (inclusive) as (major, minor, patch) tuples'
+        versions = self.branches.get(branch, [])
+        i = bisect.bisect_left(versions, low) if low is not None else 0
+        j = bisect.bisect_right(versions, high) if high is not None else len(versions)
+        return versions[i:j]
+
+    def versions(self, branch=None):
+        'Return all versions on the branch (or all branches) as a sorted list of VersionInfo objects'
+        branches = [branch] if branch else sorted(self.branches)
+        return [VersionInfo(*v, branch=b) for b in branches for v in self.branches.get(b, [])]
+
+    def version_set(self):
+        'Return all the versions as a VersionSet'
+        return VersionSet(sorted_keys=[(b,) + v for b in sorted(self.branches) for v in self.branches[b]])
+
+# Cached ref state for each repos, keyed by absolute path.  Filled by a single
+# git for-each-ref query and dropped whenever gitmake changes the refs.
+repos_state = {}
+
+# Ref updates queued by GitRepos.push, as tuples: (repos dir, remote, ref, remote enabled)
+pending_pushes = []
+
+# Number of git processes spawned by do() during this run
+git_process_count = 0
+
 class GitRepos(object):
     def __init__(self, url=None, dir=None, remote=False):
-        self.url = url or do('git config --get remote.origin.url', show=False)[1].strip()
         self.dir = os.path.abspath(dir) if dir else os.curdir
+        self.key = os.path.abspath(self.dir)
         self.remote = remote 
+        if url:
+            self.state['url'] = url
+
+    @property
+    def state(self):
+        return repos_state.setdefault(self.key, {})
+
+    @property
+    def url(self):
+        return self.get_url()
+
+    def invalidate(self):
+        'Forget everything cached about the refs of this repos.  Called after any operation that changes them.'
+        state = self.state
+        repos_state[self.key] = dict((k, state[k]) for k in ('url', 'index') if k in state)
+
+    @traced('git')
+    def get_url(self):
+        if 'url' not in self.state:
+            with cd(self.dir):
+                self.state['url'] = do('git config --get remote.origin.url', show=False)[1].strip()
+        return self.state['url']
+
+    @traced('git')
+    def get_refs(self):
+        'Get all refs of the repos with a single git query.  Returns a tuple: (current branch, branches, tags)'
+        if 'refs' not in self.state:
+            with cd(self.dir):
+                rc, output = do("git for-each-ref --format='%(HEAD) %(refname)' refs/heads refs/remotes refs/tags", show=False)
+            if rc != 0:
+                raise Exception("Couldn't get list of refs: %s" % output)
+            current_branch = 'HEAD'
+            branches = []
+            tags = []
+            for line in output.split('\n'):
+                if not line.strip():
+                    continue
+                head, ref = line[0], line[2:].strip()
+                if ref.startswith('refs/tags/'):
+                    tags.append(ref[len('refs/tags/'):])
+                elif ref.startswith('refs/heads/'):
+                    if head == '*':
+                        current_branch = ref[len('refs/heads/'):]
+                    else:
+                        branches.append(ref[len('refs/heads/'):])
+                else:
+                    branches.append(ref[len('refs/'):])
+            self.state['refs'] = (current_branch, branches, tags)
+        return self.state['refs']
+
+    @traced('git')
     def checkout(self, branch):
         with cd(self.dir):
             do('git checkout %s' % branch)
+        self.invalidate()
     
+    @traced('git')
     def reset(self):
         with cd(self.dir):
             do('git reset --hard HEAD')
+        self.invalidate()
 
+    @traced('git')
     def commit(self, all=False, msg=''):
         with cd(self.dir):
             do('git commit %s -m "%s"' % ('-a' if all else '', msg))
+        self.invalidate()
 
+    @traced('git')
     def add(self, *files):
         files = ' '.join(['"'+os.path.abspath(file)+'"' for file in files])
         with cd(self.dir):
             do('git add %s' % files)
 
-    def clone(self):
-        do('git clone "%s" "%s"' % (self.url, self.dir))
+    @traced('git')
+    def clone(self, reference=None):
+        if reference:
+            do('git clone --reference "%s" "%s" "%s"' % (reference, self.url, self.dir))
+        else:
+            do('git clone "%s" "%s"' % (self.url, self.dir))
+        self.invalidate()
+
+    @traced('git')
+    def get_source_key(self, exclude=()):
+        '''
+        Get a hash of the source in the working copy: the HEAD tree, plus uncommitted changes and untracked files (but
+        not ignored ones, nor the paths in exclude).  Files are hashed without writing them to the object database.
+        '''
+        import hashlib
+        # Paths outside the working copy can't be in a pathspec, and don't need to be left out anyway
+        exclude = [path for path in exclude if not os.path.isabs(path) and not os.path.normpath(path).startswith(os.pardir)]
+        pathspec = ' '.join(['.'] + ['":(exclude)%s"' % path for path in exclude])
+        with cd(self.dir):
+            rc, tree = do('git rev-parse -q --verify "HEAD^{tree}"', show=False)
+            if rc != 0:
+                tree = ''
+            # Paths relative to here, like ls-files.  Without a HEAD commit everything in the index is a change
+            diff = 'git diff --relative --name-only -z HEAD --' if tree else 'git ls-files -z --'
+            rc, changed = do('%s %s' % (diff, pathspec), show=False)
+            if rc != 0:
+                raise Exception("Couldn't list the changes in the working copy: %s" % changed)
+            rc, untracked = do('git ls-files -o --exclude-standard -z -- %s' % pathspec, show=False)
+            if rc != 0:
+                raise Exception("Couldn't list the untracked files in the working copy: %s" % untracked)
+            paths = sorted(set(path for path in (changed + untracked).split('\0') if path))
+            present = [path for path in paths if os.path.isfile(path) or os.path.islink(path)]
+            hashes = []
+            if present:
+                rc, output = do('git hash-object --stdin-paths', show=False, input=''.join(os.path.abspath(path) + '\n' for path in present))
+                if rc != 0:
+                    raise Exception("Couldn't hash the changes in the working copy")
+                hashes = output.split()
+        files = dict(zip(present, hashes))
+        # Deleted files are part of the change too
+        changes = [(path, files.get(path)) for path in paths]
+        return hashlib.sha1(json.dumps([tree.strip(), changes])).hexdigest()
 
+    @traced('git')
     def get_branches(self):
         'Get the names of all branches.  The first one is the current branch'
-        with cd(self.dir):
-            rc, output = do('git branch -a', show=False)
-            retval = []
-            for line in output.split('\n'):
-                if line.strip().startswith('*'):
-                    current_branch = line.lstrip('*').strip()
-                else:
-                    branch = line.strip()
-                    if branch:
-                        retval.append(branch)
-            return [current_branch] + retval
+        current_branch, branches, tags = self.get_refs()
+        return [current_branch] + branches
 
+    @traced('git')
     def get_current_branch(self):
         return self.get_branches()[0]
         
+    @traced('git')
+    def get_version_index(self):
+        'Get the version index of the repos, rebuilding it if the tags have changed since it was saved'
+        index = self.state.get('index')
+        if index is None:
+            index = VersionIndex(find_git_dir(self.key))
+            index.load()
+            self.state['index'] = index
+        # Another gitmake process may have saved an up to date index since it was loaded
+        if not index.is_current() and not index.load():
+            stamp = index.fingerprint()
+            self.invalidate()
+            index.rebuild(self.get_refs()[2], stamp)
+        return index
+
+    @traced('git')
     def get_tags(self, branch=None):
-        with cd(self.dir):
-            if branch:
-                rc, output = do('git tag -l v*.*.*-%s' % branch, show=False)
-            else:
-                rc, output = do('git tag -l v*.*.*-*', show=False)
-            if rc != 0:
-                raise Exception("Couldn't get list of tags: %s" % output)
-            versions = [x.strip() for x in output.split('\n') if x.strip() != '']
-            retval = []
-            for version in versions:
-                try:
-                    retval.append(VersionInfo.from_string(version))
-                except:
-                    pass
-            retval.sort()
-            return retval
+        'Get the sorted list of versions tagged on the branch (or on all branches)'
+        return self.get_version_index().versions(branch)
+
+    @traced('git')
+    def get_latest_version(self, branch):
+        'Get the latest version tagged on the branch, or None'
+        return self.get_version_index().latest(branch)
+
+    @traced('git')
+    def has_version(self, version):
+        return self.get_version_index().contains(version)
 
+    def get_version_set(self):
+        'Get all the versions tagged in the repos as a VersionSet'
+        return self.get_version_index().version_set()
+
+    @traced('git')
     def push(self, branch='master', remote='origin'):
-        cmd = 'git push %s %s' % (remote, branch)
+        'Queue the branch or tag to be pushed to the remote.  Queued refs are pushed together by do_push_queued().'
+        current_branch, branches, tags = self.get_refs()
+        ref = ('refs/tags/%s' if branch in tags else 'refs/heads/%s') % branch
+        entry = (self.key, remote, ref, self.remote)
+        if entry not in pending_pushes:
+            message('Queueing %s to be pushed to %s' % (ref, remote))
+            pending_pushes.append(entry)
+
+    @traced('git')
+    def push_new_ref(self, ref, remote='origin'):
+        '''
+        Push a ref that must not exist on the remote yet, right away.  Return False if the remote already has it.
+        With remote operations disabled the ref is queued like any other push, and True is returned.
+        '''
+        if not self.remote:
+            self.push(ref.split('/', 2)[-1], remote)
+            return True
+        message('Pushing %s to %s' % (ref, remote))
+        with cd(self.dir):
+            for attempt in range(TAG_ATTEMPTS):
+                rc, output = do('git push --porcelain %s %s:%s' % (remote, ref, ref), show=False)
+                if rc == 0:
+                    return True
+                if '[rejected]' in output:
+                    return False
+                if '[remote rejected]' not in output:
+                    break
+                # The remote couldn't lock the ref, because another push of it is in progress.  Retry unless that one won.
+                if do('git ls-remote --exit-code %s %s' % (remote, ref), show=False)[0] == 0:
+                    return False
+                time.sleep(0.1 * (attempt + 1))
+        raise Exception("Couldn't push %s to %s: %s" % (ref, remote, output))
+
+    @traced('git')
+    def fetch_tags(self, pattern, remote='origin'):
+        'Fetch the tags matching the pattern (which may contain one *) from the remote'
+        with cd(self.dir):
+            do('git fetch -q %s "refs/tags/%s:refs/tags/%s"' % (remote, pattern, pattern), show=False)
+        self.invalidate()
+
+    @traced('git')
+    def delete_tag(self, tag):
+        with cd(self.dir):
+            do('git tag -d %s' % tag, show=False)
+        self.invalidate()
+
+    @traced('git')
+    def drop_last_commit(self):
+        'Move the current branch back to the parent of its last commit, keeping any local changes'
+        with cd(self.dir):
+            rc, output = do('git reset -q --keep HEAD^')
+        self.invalidate()
+        if rc != 0:
+            raise Exception("Couldn't drop the last commit: %s" % output)
+
+    @traced('git')
+    def create_orphan_branch(self, branch):
+        '''
+        Create a branch with no history, containing only a README, without touching the working copy.
+        Return the hash of its commit.
+        '''
+        blob = self.write_blob(data='This is the %s branch.' % branch)
+        tree = self.write_tree([('100644', 'blob', blob, 'README')])
+        commit = self.commit_tree(tree, msg='Initial commit')
+        self.update_ref('refs/heads/%s' % branch, commit, old='')
         if self.remote:
-            with cd(self.dir):
-                do(cmd)
+            self.push(branch)
+        return commit
+
+    @traced('git')
+    def resolve(self, ref):
+        'Get the hash of the commit the ref points to, or None if there is no such ref'
+        with cd(self.dir):
+            rc, output = do('git rev-parse -q --verify %s^{commit}' % ref, show=False)
+        return output.strip() if rc == 0 else None
+
+    @traced('git')
+    def read_tree(self, treeish):
+        'Get the entries of a tree as a list of tuples: (mode, type, hash, name)'
+        with cd(self.dir):
+            rc, output = do('git ls-tree -z %s' % treeish, show=False)
+        if rc != 0:
+            raise Exception("Couldn't read tree %s" % treeish)
+        entries = []
+        for line in output.split('\0'):
+            if line:
+                info, name = line.split('\t', 1)
+                entries.append(tuple(info.split()) + (name,))
+        return entries
+
+    @traced('git')
+    def write_blob(self, path=None, data=None):
+        'Write the file at path (or the data given) to the object database.  Return the hash of the blob.'
+        with cd(self.dir):
+            if path is not None:
+                rc, output = do('git hash-object -w -- "%s"' % os.path.abspath(path), show=False)
+            else:
+                rc, output = do('git hash-object -w --stdin', show=False, input=data)
+        if rc != 0:
+            raise Exception("Couldn't write blob: %s" % output)
+        return output.strip()
+
+    @traced('git')
+    def write_blobs(self, paths):
+        'Write the files at the paths to the object database with a single git process.  Return the hashes of the blobs.'
+        with cd(self.dir):
+            rc, output = do('git hash-object -w --stdin-paths', show=False, input=''.join(os.path.abspath(path) + '\n' for path in paths))
+        blobs = output.split()
+        if rc != 0 or len(blobs) != len(paths):
+            raise Exception("Couldn't write blobs: %s" % output)
+        return blobs
+
+    @traced('git')
+    def write_tree(self, entries):
+        'Write a tree with the entries given as tuples: (mode, type, hash, name).  Return the hash of the tree.'
+        data = ''.join('%s %s %s\t%s\0' % entry for entry in entries)
+        with cd(self.dir):
+            rc, output = do('git mktree -z', show=False, input=data)
+        if rc != 0:
+            raise Exception("Couldn't write tree: %s" % output)
+        return output.strip()
+
+    @traced('git')
+    def replace_in_tree(self, tree, path, blob):
+        'Write a copy of the tree with the file at path (with / separators) set to the blob.  Return the hash of the new tree.'
+        name, sep, rest = path.partition('/')
+        entries = self.read_tree(tree)
+        old = [entry for entry in entries if entry[3] == name]
+        entries = [entry for entry in entries if entry[3] != name]
+        if rest:
+            subtree = old[0][2] if old and old[0][1] == 'tree' else self.write_tree([])
+            entries.append(('040000', 'tree', self.replace_in_tree(subtree, rest, blob), name))
         else:
-            message("Skipping remote operation: %s" % cmd)
+            entries.append((old[0][0] if old else '100644', 'blob', blob, name))
+        return self.write_tree(entries)
 
-    def create_orphan_branch(self, branch):
+    @traced('git')
+    def commit_tree(self, tree, parents=(), msg=''):
+        'Create a commit of the tree with the given parents.  Return the hash of the commit.'
         with cd(self.dir):
-            do_all(['git checkout --orphan %s' % branch, 'git rm -rf .'])
-            with open('README','w') as fp:
-                fp.write('This is the %s branch.' % branch)
-            self.add('README')
-            self.commit(msg='Initial commit')
-            if self.remote:
-                self.push(branch)
-
-    def tag(self, tag, msg=''):
+            rc, output = do('git commit-tree %s %s' % (tree, ' '.join('-p %s' % p for p in parents)), show=False, input=msg)
+        if rc != 0:
+            raise Exception("Couldn't create commit: %s" % output)
+        return output.strip()
+
+    @traced('git')
+    def update_ref(self, ref, new, old=None):
+        'Point the ref at a new commit.  If old is given the update only happens if the ref still has that value (empty means it must not exist).'
         with cd(self.dir):
-            do('git tag -a %s -m "%s"' % (tag, msg or 'Tag auto generated by gitmake.py'))
+            rc, output = do('git update-ref %s %s %s' % (ref, new, '"%s"' % old if old is not None else ''), show=False)
+        self.invalidate()
+        if rc != 0:
+            raise Exception("Couldn't update %s: %s" % (ref, output))
 
-def do(cmd, show=True):
-    'Execute the provided command with the shell.  Show the output if specified. Return a tuple: (ret code, command output)'
-    returncode = 0
-    try:
+    @traced('git')
+    def tag(self, tag, msg='', commit=''):
+        '''
+        Tag the commit (HEAD by default).  Return True if the tag was created.  The version index follows the new tag if it
+        was up to date before it, and is otherwise left for the next reader to rebuild.
+        '''
+        index = VersionIndex(find_git_dir(self.key))
+        with index.locked():
+            current = index.load()
+            with cd(self.dir):
+                rc, output = do('git tag -a %s -m "%s" %s' % (tag, msg or 'Tag auto generated by gitmake.py', commit))
+            self.invalidate()
+            if rc == 0 and current:
+                try:
+                    index.add(VersionInfo.from_string(tag))
+                except ValueError:
+                    pass
+        self.state['index'] = index
+        return rc == 0
+
+    @traced('git')
+    def is_ancestor(self, commit, descendant):
+        with cd(self.dir):
+            return do('git merge-base --is-ancestor %s %s' % (commit, descendant), show=False)[0] == 0
+
+    @traced('git')
+    def get_prefix(self):
+        'Get the path of the current directory relative to the top of the working copy, with a trailing / (or empty at the top)'
+        with cd(self.dir):
+            return do('git rev-parse --show-prefix', show=False)[1].strip()
+
+class ObjectReader(object):
+    '''
+    Reads objects from a repos through a single long-lived git cat-file --batch process, rather than a git process per object.
+    Objects are named as git rev-parse names them: a hash, or <tree>:<path> for instance.
+    '''
+    def __init__(self, dir=None):
+        import subprocess
+        global git_process_count
+        git_process_count += 1
+        self.process = subprocess.Popen(['git', 'cat-file', '--batch'], cwd=dir, bufsize=-1, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def open(self, name, type='blob'):
+        '''
+        Read an object into a seekable file: in memory up to OBJECT_SPOOL_SIZE bytes, and a temporary file beyond that.
+        Raise KeyError if there is no such object of the given type.
+        '''
+        import tempfile
+        from cStringIO import StringIO
+        self.process.stdin.write(name + '\n')
+        self.process.stdin.flush()
+        header = self.process.stdout.readline()
+        if not header:
+            raise Exception('git cat-file exited while reading %s' % name)
+        header = header.split()
+        if len(header) != 3 or header[-1] in ('missing', 'ambiguous'):
+            raise KeyError(name)
+        size = int(header[2])
+        if size <= OBJECT_SPOOL_SIZE:
+            fp = StringIO(self.process.stdout.read(size))
+            size -= len(fp.getvalue())
+        else:
+            fp = tempfile.TemporaryFile()
+        while size > 0:
+            chunk = self.process.stdout.read(min(size, HASH_CHUNK_SIZE))
+            if not chunk:
+                raise Exception('git cat-file exited while reading %s' % name)
+            fp.write(chunk)
+            size -= len(chunk)
+        self.process.stdout.read(1)
+        if header[1] != type:
+            raise KeyError(name)
+        fp.seek(0)
+        return fp
+
+    def tree_entry(self, tree, path):
+        'Return the (mode, hash) of the entry at path (with / separators) under the tree.  Raise KeyError if there is none.'
+        hash_size = len(tree) // 2
+        mode, hash = '40000', tree
+        for name in path.strip('/').split('/'):
+            if mode != '40000':
+                raise KeyError(path)
+            data = self.open(hash, 'tree').read()
+            i = 0
+            while i < len(data):
+                j = data.index('\0', i)
+                mode, entry = data[i:j].split(' ', 1)
+                hash = data[j+1:j+1+hash_size].encode('hex')
+                i = j + 1 + hash_size
+                if entry == name:
+                    break
+            else:
+                raise KeyError(path)
+        return mode, hash
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+class ReleaseIndex(object):
+    '''
+    Index of the releases on the release branch, persisted in .git/gitmake/releases.json.  Each release is a dict of
+    its storage, its name and object in the tree of the branch, and (for bundles) its format and size.  The index is
+    stamped with the commit of the release branch, and the tree is only listed again once the branch has moved.
+    '''
+    def __init__(self, repos, commit):
+        git_dir = find_git_dir(repos.key)
+        self.path = os.path.join(git_dir, 'gitmake', 'releases.json') if git_dir else None
+        self.commit = commit
+        self.releases = {}
+        if not self.load():
+            self.rebuild(repos)
+
+    def load(self):
+        'Load the index from disk.  Return True if it was loaded and is still current.'
+        if not self.path:
+            return False
+        try:
+            with open(self.path) as fp:
+                data = json.load(fp)
+        except (IOError, ValueError):
+            return False
+        if data.get('commit') != self.commit:
+            return False
+        self.releases = data['releases']
+        return True
+
+    def save(self):
+        if not self.path:
+            return
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            with atomic_write(self.path) as fp:
+                json.dump({'commit':self.commit, 'releases':self.releases}, fp)
+        except (IOError, OSError), e:
+            error("Couldn't save release index: %s" % e)
+
+    def rebuild(self, repos):
+        'Rebuild the index from the tree of the release branch'
+        with cd(repos.dir):
+            rc, output = do('git ls-tree -l -z %s' % self.commit, show=False)
+        if rc != 0:
+            raise Exception("Couldn't read the release branch: %s" % output)
+        self.releases = {}
+        for line in output.split('\0'):
+            if not line:
+                continue
+            info, name = line.split('\t', 1)
+            mode, type, hash, size = info.split()
+            if type == 'tree' and VERSION_RE.match(name):
+                self.releases[name] = {'storage':'tree', 'name':name, 'object':hash}
+                continue
+            m = RELEASE_NAME_RE.search(name)
+            if type == 'blob' and m:
+                format = [f for f, ext in BUNDLE_FORMATS.items() if ext == m.group(2)][0]
+                self.releases[m.group(1)] = {'storage':'bundle', 'name':name, 'object':hash, 'format':format, 'size':int(size)}
+        self.save()
+
+    def versions(self):
+        'Return the released versions as a sorted list of VersionInfo objects'
+        return sorted(VersionInfo.from_string(tag) for tag in self.releases)
+
+class ArtifactCache(object):
+    '''
+    Local cache of build outputs.  Entries are keyed by the tree hash of the source, the build command
+    and the gitmake version, and are evicted least recently used first once the cache grows past max_size bytes.
+    '''
+    def __init__(self, dir, max_size):
+        self.dir = os.path.abspath(os.path.expanduser(dir))
+        self.max_size = max_size
+
+    def key(self, tree, build_command):
+        import hashlib
+        return hashlib.sha256(json.dumps([tree, build_command, version_string])).hexdigest()
+
+    def restore(self, key):
+        'Copy the cached outputs for key into the current directory.  Return False on a cache miss.'
+        import shutil
+        entry = os.path.join(self.dir, key)
+        try:
+            with open(os.path.join(entry, 'entry.json')) as fp:
+                files = json.load(fp)['files']
+        except (IOError, ValueError):
+            return False
+        for file in files:
+            if os.path.dirname(file) and not os.path.isdir(os.path.dirname(file)):
+                os.makedirs(os.path.dirname(file))
+            shutil.copy2(os.path.join(entry, 'files', file), file)
+        os.utime(entry, None)
+        return True
+
+    def store(self, key, files):
+        'Copy the files (paths relative to the current directory) into the cache under key'
+        import shutil
+        entry = os.path.join(self.dir, key)
+        if os.path.exists(entry):
+            return
+        tmp = '%s.tmp-%d' % (entry, os.getpid())
+        size = 0
+        for file in files:
+            dest = os.path.join(tmp, 'files', file)
+            if not os.path.isdir(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+            shutil.copy2(file, dest)
+            size += os.path.getsize(file)
+        with open(os.path.join(tmp, 'entry.json'), 'w') as fp:
+            json.dump({'files':files, 'size':size}, fp)
+        os.rename(tmp, entry)
+        self.evict()
+
+    def evict(self):
+        'Remove the least recently used entries until the cache fits in max_size'
+        import shutil
+        entries = []
+        for name in os.listdir(self.dir):
+            entry = os.path.join(self.dir, name)
+            try:
+                with open(os.path.join(entry, 'entry.json')) as fp:
+                    size = json.load(fp)['size']
+            except (IOError, ValueError):
+                continue
+            entries.append((os.path.getmtime(entry), size, entry))
+        entries.sort()
+        total = sum(size for mtime, size, entry in entries)
+        while entries and total > self.max_size:
+            mtime, size, entry = entries.pop(0)
+            message('Evicting %s from the build cache' % os.path.basename(entry))
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+def get_artifact_cache(args, settings):
+    'Return the build cache configured in the settings, or None if caching is disabled'
+    max_size = settings['settings'].get('cache_size_mb', DEFAULT_CACHE_SIZE_MB)
+    if not getattr(args, 'cache', True) or not max_size:
+        return None
+    dir = settings['settings'].get('cache_directory') or cache_directory('artifacts')
+    return ArtifactCache(dir, max_size*1024*1024)
+
+def cache_directory(*parts):
+    'Return the path of a directory in the gitmake cache ($XDG_CACHE_HOME/gitmake, or ~/.cache/gitmake)'
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'gitmake', *parts)
+
+def do(cmd, show=True, input=None, log=None, prefix=''):
+    '''
+    Execute the provided command with the shell, feeding it input on stdin if given.  Return a tuple: (ret code, command output)
+    If show is specified or a log file object is given, stdout is read line by line as it arrives, shown with a timestamp (if
+    show is specified), written to the log (if given, along with stderr) with a timestamp and prefix in front of each line, and
+    only the last DO_TAIL_LINES lines, as the command wrote them, are kept in the returned output.  Otherwise, the complete
+    stdout is returned.
+    '''
+    with trace_span(cmd.strip()[:TRACE_NAME_LENGTH], 'do'):
+        return run_command(cmd, show, input, log, prefix)
+
+def run_command(cmd, show, input, log, prefix=''):
+    'Implementation of do()'
+    import subprocess
+    global git_process_count
+    if cmd.split(None, 1)[:1] == ['git']:
+        git_process_count += 1
+    if show:
+        command(cmd.strip())
+    if not (show or log) or input is not None:
+        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stdin=subprocess.PIPE if input is not None else None)
+        output = p.communicate(input)[0]
         if show:
-            command(cmd.strip())
-        output = subprocess.check_output(cmd, shell=True)
-    except subprocess.CalledProcessError, e:
-        returncode = e.returncode
-        output = e.output
-    if(show):
-        print str(output.strip())
-    return (returncode, output)
+            print str(output.strip())
+        return (p.returncode, output)
+
+    if log:
+        log.write('%s$ %s\n' % (prefix, cmd.strip()))
+    # Without a log, stderr goes straight to the console, as it does for the commands that aren't shown
+    p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT if log else None)
+    tail = collections.deque(maxlen=DO_TAIL_LINES)
+    for line in iter(p.stdout.readline, ''):
+        stamped = '[%s] %s' % (time.strftime('%H:%M:%S'), line if line.endswith('\n') else line + '\n')
+        if show:
+            sys.stdout.write(stamped)
+            sys.stdout.flush()
+        if log:
+            log.write(prefix + stamped)
+        tail.append(line)
+    p.stdout.close()
+    return (p.wait(), ''.join(tail))
+
+@contextmanager
+def build_log(dir):
+    'Open a new compressed log file in dir for writing, deleting all but the newest BUILD_LOGS_KEPT logs'
+    import gzip
+    if not os.path.isdir(dir):
+        os.makedirs(dir)
+    logs = sorted(f for f in os.listdir(dir) if f.startswith('build-') and f.endswith('.log.gz'))
+    for old_log in logs[:max(0, len(logs) - BUILD_LOGS_KEPT + 1)]:
+        os.remove(os.path.join(dir, old_log))
+    path = os.path.join(dir, 'build-%s-%d.log.gz' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+    fp = gzip.open(path, 'wb')
+    try:
+        yield fp, path
+    finally:
+        fp.close()
+
+class LockedFile(object):
+    'Wrap a file object so that it can be written from several threads at once, a whole write at a time'
+    def __init__(self, fp):
+        import threading
+        self.fp = fp
+        self.lock = threading.Lock()
+
+    def write(self, data):
+        with self.lock:
+            self.fp.write(data)
 
 def do_all(command_list, show=False, stop_on_error=True):
     '''
@@ -205,6 +1137,45 @@ def do_all(command_list, show=False, stop_on_error=True):
             return (False, msg), retval
     return (True,''), retval
 
+@traced('phase')
+def do_push_queued():
+    '''
+    Push all the queued ref updates with a single atomic push per remote, so that the remote gets all of them or none.
+    The push is made from the repos that queued last, and refs queued in other repositories are fetched into it first.
+    Updates queued by GitRepos objects with remote operations disabled are only listed.  Return True on success.
+    '''
+    global pending_pushes
+    queued, pending_pushes = pending_pushes, []
+    remotes = []
+    for dir, remote, ref, enabled in queued:
+        if remote not in remotes:
+            remotes.append(remote)
+    for remote in remotes:
+        skipped = [ref for dir, r, ref, enabled in queued if r == remote and not enabled]
+        if skipped:
+            message('Skipping remote operation: git push --atomic %s %s' % (remote, ' '.join(skipped)))
+    queued = [entry for entry in queued if entry[3]]
+    if not queued:
+        return True
+
+    pusher = queued[-1][0]
+    git_dir = find_git_dir(pusher)
+    ok = True
+    with cd(pusher):
+        for dir, remote, ref, enabled in queued:
+            if find_git_dir(dir) != git_dir:
+                do('git fetch "%s" %s:%s' % (dir, ref, ref), show=False)
+        for remote in remotes:
+            refs = [ref for dir, r, ref, enabled in queued if r == remote]
+            if refs:
+                message('Pushing %s to %s' % (', '.join(refs), remote))
+                rc, output = do('git push --atomic %s %s' % (remote, ' '.join('%s:%s' % (ref, ref) for ref in refs)))
+                ok = ok and rc == 0
+    GitRepos(dir=pusher).invalidate()
+    if not ok:
+        error('Push failed.  Nothing was pushed.')
+    return ok
+
 def confirm(message, default=True):
     while True:
         v = raw_input(message + ' (Y/n) ' if default else ' (y/N) ').strip().lower()
@@ -215,209 +1186,1613 @@ def confirm(message, default=True):
         elif v.startswith('n'):
             return False
 
-def do_build_here(build_cmd):
+@traced('phase')
+def do_build_here(build_cmd, log_dir=None):
+    'Run the build command here, logging its output to a file in log_dir if given.  Return True if the build succeeded.'
     message("Building")
-    retcode, output = do(build_cmd)
+    if log_dir:
+        with build_log(log_dir) as (log, log_path):
+            retcode, output = do(build_cmd, log=log)
+    else:
+        retcode, output = do(build_cmd)
     if retcode == 0:
        message("Build succeeded.")
        return True
     else:
        error("Build failed with error code %d" % retcode)
+       if log_dir:
+           error("The build log is in %s" % os.path.abspath(log_path))
        return False
 
-def do_clone_here(url, version=None):
+def load_build_steps(settings):
+    'Return the steps of the build settings, as a dict of name: step, after checking that their dependencies form a DAG'
+    steps = settings['build']['steps']
+    for name, step in steps.items():
+        if 'command' not in step:
+            raise Exception('Build step %s has no command' % name)
+        for dep in step.get('deps', []):
+            if dep not in steps:
+                raise Exception('Build step %s depends on the unknown step %s' % (name, dep))
+    visiting, visited = set(), set()
+    def visit(name, path):
+        if name in visited:
+            return
+        if name in visiting:
+            raise Exception('Build steps depend on each other: %s' % ' -> '.join(path + [name]))
+        visiting.add(name)
+        for dep in steps[name].get('deps', []):
+            visit(dep, path + [name])
+        visiting.discard(name)
+        visited.add(name)
+    for name in sorted(steps):
+        visit(name, [])
+    return steps
+
+def expand_paths(patterns):
+    'Expand file, directory and glob patterns into the sorted list of files they cover.  Patterns matching nothing are ignored.'
+    return sorted(set(path for match, paths in expand_patterns(patterns) for path in paths))
+
+def hash_paths(paths, known):
+    '''
+    Return a dict of path: [size, mtime, SHA-256 digest] for the files.  The digests in known (a dict of the same form)
+    are reused for files whose size and mtime haven't changed.
+    '''
+    retval = {}
+    for path in paths:
+        st = os.stat(path)
+        old = known.get(path)
+        if old and old[0] == st.st_size and old[1] == st.st_mtime:
+            retval[path] = old
+        else:
+            retval[path] = list(hash_file(path))
+    return retval
+
+def files_key(*parts):
+    import hashlib
+    return hashlib.sha256(json.dumps(parts, sort_keys=True)).hexdigest()
+
+def run_build_step(name, step, prior, dep_keys, force, log=None):
+    '''
+    Run one build step, unless it has declared inputs and neither its command, the contents of its inputs nor the
+    outputs of the steps it depends on changed since it last succeeded (as recorded in prior), and its outputs exist.
+    The output of the step is written to log as it arrives, each line prefixed with the name of the step, and the
+    result keeps its last lines.  Runs on a thread of do_build_steps_here.  Return the result as a dict.
+    '''
+    start = time.time()
+    result = {'name':name, 'status':None, 'output':'', 'returncode':0}
+    try:
+        inputs = step.get('inputs')
+        outputs = step.get('outputs', [])
+        if inputs is not None and None not in dep_keys:
+            result['files'] = hash_paths(expand_paths(inputs), prior.get('files', {}))
+            result['key'] = files_key(step['command'], [(path, f[2]) for path, f in result['files'].items()], dep_keys)
+            if not force and result['key'] == prior.get('key') and all(expand_paths([output]) for output in outputs):
+                result['status'] = 'up to date'
+        if not result['status']:
+            result['returncode'], result['output'] = do(step['command'], show=False, log=log, prefix='[%s] ' % name)
+            result['status'] = 'built' if result['returncode'] == 0 else 'failed'
+        if result['status'] != 'failed':
+            # What the steps depending on this one see of it.  None makes them run, since this step always runs.
+            if outputs:
+                result['outputs_key'] = files_key([(path, f[2]) for path, f in sorted(hash_paths(expand_paths(outputs), {}).items())])
+            else:
+                result['outputs_key'] = result.get('key')
+    except Exception, e:
+        result.update(status='failed', output=str(e))
+    result['time'] = time.time() - start
+    return result
+
+def run_build_steps(steps, state, jobs, force, log):
+    '''
+    Run the steps on a pool of jobs threads, each as soon as the steps it depends on have succeeded, and no more once one
+    fails.  state holds what run_build_step needs to skip the steps that are up to date, and is updated as they finish.
+    Return a tuple (results, failed), where results is a dict of step name: result
+    '''
+    import Queue
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(jobs)
+    finished = Queue.Queue()
+    results = {}
+    running = set()
+    failed = False
+    while True:
+        for name in [] if failed else sorted(steps):
+            deps = steps[name].get('deps', [])
+            if name in results or name in running or any(dep not in results for dep in deps):
+                continue
+            running.add(name)
+            dep_keys = [results[dep].get('outputs_key') for dep in sorted(deps)]
+            pool.apply_async(run_build_step, (name, steps[name], state.get(name, {}), dep_keys, force, log), callback=finished.put)
+        if not running:
+            break
+        # A timeout keeps the wait interruptible with Ctrl-C
+        result = finished.get(True, 0xFFFFFF)
+        name = result['name']
+        running.discard(name)
+        results[name] = result
+        if result['status'] == 'failed':
+            failed = True
+            state.pop(name, None)
+            error('Step %s failed with error code %d in %0.1fs:' % (name, result['returncode'], result['time']))
+            print result['output'].rstrip()
+        else:
+            state[name] = dict((k, result[k]) for k in ('key', 'files') if k in result)
+            message('Step %s %s in %0.1fs' % (name, result['status'], result['time']))
+    pool.close()
+    return results, failed
+
+def build_steps_state_path(settings):
+    '''
+    Return the path of the file keeping what the build steps last built.  It is in .git/gitmake, where cleaning up the build
+    directory leaves it alone, and holds the steps of every working copy (worktrees included) by directory.
+    '''
+    git_dir = find_git_dir(os.curdir)
+    if not git_dir:
+        return os.path.join(settings['settings']['build_directory'], 'steps.json')
+    return os.path.join(git_dir, 'gitmake', 'steps.json')
+
+@traced('phase')
+def do_build_steps_here(settings, force=False, log_dir=None):
+    '''
+    Run the steps of the build settings, each as soon as the steps it depends on have succeeded, with at most build.jobs
+    (by default the number of CPUs) running at once.  Steps that are up to date are skipped (see run_build_step), unless
+    force is given.  No more steps are started once one fails.  The output of the steps goes to a log in log_dir, if given.
+    The status and time of each step are shown as it finishes, and in a summary at the end.  Return True if all the steps
+    succeeded.
+    '''
+    import multiprocessing
+    steps = load_build_steps(settings)
+    state_path = build_steps_state_path(settings)
+    here = os.path.abspath(os.curdir)
+    def load_state():
+        try:
+            with open(state_path) as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return {}
+    state = load_state().get(here, {})
+    jobs = settings['build'].get('jobs') or multiprocessing.cpu_count()
+    message('Building %d steps, up to %d at once' % (len(steps), jobs))
+    start = time.time()
+    if log_dir:
+        with build_log(log_dir) as (log, log_path):
+            results, failed = run_build_steps(steps, state, jobs, force, LockedFile(log))
+    else:
+        with open(os.devnull, 'w') as log:
+            results, failed = run_build_steps(steps, state, jobs, force, LockedFile(log))
+
+    # Other working copies may have saved their steps in the meantime, and the ones that are gone are dropped
+    all_states = dict((dir, dir_state) for dir, dir_state in load_state().items() if os.path.isdir(dir))
+    all_states[here] = state
+    if not os.path.isdir(os.path.dirname(state_path)):
+        os.makedirs(os.path.dirname(state_path))
+    with atomic_write(state_path) as fp:
+        json.dump(all_states, fp)
+
+    message('Build steps:')
+    for name in sorted(steps):
+        if name in results:
+            message('  %-24s %-12s %8.1fs' % (name, results[name]['status'], results[name]['time']))
+        else:
+            message('  %-24s %-12s' % (name, 'not run'))
+    if failed:
+        error('Build failed after %0.1fs' % (time.time() - start))
+        if log_dir:
+            error('The build log is in %s' % os.path.abspath(log_path))
+        return False
+    message('Build succeeded in %0.1fs.' % (time.time() - start))
+    return True
+
+def build_description(settings):
+    'Return what the build runs, as a string: the build command, or the build steps'
+    build = settings['build']
+    return json.dumps(build['steps'], sort_keys=True) if 'steps' in build else build['build_command']
+
+@traced('phase')
+def do_cached_build_here(args, settings):
+    '''
+    Build here, unless this source tree was already built with the same build command (or steps), in which case the
+    build outputs (the release files) are restored from the build cache.  Return True if the build succeeded.
+    '''
+    build_cmd = build_description(settings)
+    log_dir = os.path.join(settings['settings']['build_directory'], 'logs')
+    def build():
+        if 'steps' in settings['build']:
+            return do_build_steps_here(settings, not getattr(args, 'cache', True), log_dir)
+        return do_build_here(build_cmd, log_dir)
+    cache = get_artifact_cache(args, settings)
+    if not cache:
+        return build()
+    # The build directory and the build outputs are left out, so that building doesn't change the key
+    outputs = [settings['settings']['build_directory']] + settings['release']['files']
+    key = cache.key(GitRepos().get_source_key(outputs), build_cmd)
+    if cache.restore(key):
+        message('Restored build outputs from the build cache.  Skipping build.')
+        return True
+    if not build():
+        return False
+    here = os.path.abspath(os.curdir)
+    try:
+        files = [os.path.relpath(path, here) for path, name in expand_release_files(settings['release']['files'])]
+        files = [f for f in files if not f.startswith(os.pardir)]
+        message('Storing %d build outputs in the build cache' % len(files))
+        cache.store(key, files)
+    except Exception, e:
+        error('Not caching build outputs: %s' % e)
+    return True
+
+@traced('phase')
+def do_clone_here(url, version=None, reference=None):
     repos = GitRepos(url=url)
     message('Cloning repos %s' % url)
-    repos.clone()
+    repos.clone(reference=reference)
     if version:
-        tags = repos.get_tags()
-        if version in tags:
+        if not repos.has_version(version) and reference:
+            # The tag may not have been pushed yet (--noremote) so take it from the local repos
+            message('Fetching %s from the local repos' % version.tag)
+            do('git fetch "%s" refs/tags/%s:refs/tags/%s' % (reference, version.tag, version.tag))
+            repos.invalidate()
+        if repos.has_version(version):
             message('Checking out %s' % version.tag)
             repos.checkout(version.tag)
         else:
             error('Cannot checkout %s: No such tag exists.' % version.tag)
             sys.exit(1)
-    
+
+@traced('phase')
+def do_checkout_here(args, settings, version, git_dir, url):
+    '''
+    Materialize the tagged version in the current (empty) directory.  git_dir is the git directory of
+    the local repos (or None if there isn't one) and url is the remote to release to.  How the tag is
+    materialized is chosen by the --checkout option or the settings.checkout setting:
+      reference - clone the remote, borrowing objects from the local repos (default)
+      worktree  - add a detached git worktree of the local repos
+      clone     - full clone of the remote
+      shallow   - shallow clone of just the tag and the branch tips
+    Without a local repos, a shallow clone is always used.
+    '''
+    mode = getattr(args, 'checkout', None) or settings['settings'].get('checkout', 'reference')
+    if mode not in CHECKOUT_MODES:
+        error('Unknown checkout mode "%s".  Valid modes are: %s' % (mode, ', '.join(CHECKOUT_MODES)))
+        sys.exit(1)
+    if not git_dir and mode != 'shallow':
+        message('No local repos available.  Falling back to a shallow clone.')
+        mode = 'shallow'
+
+    if mode == 'worktree':
+        message('Adding worktree for %s' % version.tag)
+        rc, output = do('git --git-dir="%s" worktree add --detach "%s" %s' % (git_dir, os.path.abspath(os.curdir), version.tag))
+    elif mode == 'shallow':
+        message('Shallow cloning %s from %s' % (version.tag, url))
+        rc, output = do('git clone --depth 1 --no-single-branch --branch %s "%s" .' % (version.tag, url))
+    else:
+        return do_clone_here(url, version, reference=git_dir if mode == 'reference' else None)
+    GitRepos(url=url).invalidate()
+    if rc != 0:
+        error('Cannot checkout %s: %s' % (version.tag, output.strip()))
+        sys.exit(1)
+
+@traced('phase')
+def do_remove_build_dir(build_dir):
+    'Delete the build directory, and prune the metadata of any git worktrees it held (at any depth, such as per-tag worktrees)'
+    do('rm -Rf %s' % build_dir)
+    if find_git_dir(os.curdir):
+        do('git worktree prune', show=False)
+
+@traced('phase')
 def do_make_build_dir_here(args, settings):
     'Delete the build directory if it already exists, and create a new one here.  Return the path to the build dir.'
     build_dir = settings['settings']['build_directory']
     message('Creating build directory here: %s' % os.path.abspath(build_dir))
-    do('rm -Rf %s' % build_dir)
+    do_remove_build_dir(build_dir)
     if not os.path.exists(build_dir): os.makedirs(build_dir)
     return build_dir
 
+@traced('phase')
 def do_cleanup(args, settings):
     build_dir = settings['settings']['build_directory']
     message('Deleting build directory: %s' % os.path.abspath(build_dir))
-    do('rm -Rf %s' % build_dir)
+    do_remove_build_dir(build_dir)
 
-def do_collect_release_data_here(args, settings):
-    'Collect all the specified files and return a ZipFile object'
-    files = [os.path.abspath(f) for f in settings['release']['files']]
-    s = StringIO.StringIO()
-    with zipfile.ZipFile(s, 'w') as z:
-        for file in files:
-            z.write(file, arcname = os.path.split(file)[1])
-            message("Releasing this file: %s" % file)
-    data = s.getvalue()
-    s.close()
-    return data
+def peak_rss():
+    'Return the peak resident set size of this process in bytes'
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
 
-def do_create_tag_here(new_version, version_file, remote=True, msg=''):
-   
+def walk_files(top):
+    'Yield the paths of all the files under the directory top, in sorted order'
+    try:
+        from os import scandir
+    except ImportError:
+        try:
+            from scandir import scandir
+        except ImportError:
+            scandir = None
+    if scandir is None:
+        for root, dirs, files in os.walk(top):
+            dirs.sort()
+            for file in sorted(files):
+                yield os.path.join(root, file)
+        return
+    stack = [top]
+    while stack:
+        subdirs = []
+        for entry in sorted(scandir(stack.pop()), key=lambda e: e.name):
+            if entry.is_dir():
+                subdirs.append(entry.path)
+            elif entry.is_file():
+                yield entry.path
+        stack.extend(reversed(subdirs))
+
+def expand_patterns(patterns, kind=None):
+    '''
+    Expand file, directory and glob patterns into a list of (match, files) tuples: each file or directory matched, with
+    the sorted list of the files it covers.  Patterns matching nothing are ignored, unless the kind of file they stand
+    for (such as "release") is given, in which case a missing file is an error and an empty glob a warning.
+    '''
+    import glob
+    retval = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+            if not matches and kind:
+                error('No files match the %s pattern %s' % (kind, pattern))
+        elif os.path.exists(pattern):
+            matches = [pattern]
+        elif kind:
+            raise Exception('%s file does not exist: %s' % (kind.capitalize(), pattern))
+        else:
+            matches = []
+        for match in matches:
+            retval.append((match, list(walk_files(match)) if os.path.isdir(match) else [match]))
+    return retval
+
+def expand_release_files(patterns):
+    '''
+    Expand the release file patterns into a list of (path, archive name) tuples.  Patterns can be
+    files, directories or globs.  Files are stored under their own name, and directories are stored
+    recursively under the name of the directory.
+    '''
+    retval = []
+    names = set()
+    for match, paths in expand_patterns(patterns, 'release'):
+        if os.path.isdir(match):
+            base = os.path.split(os.path.abspath(match))[1]
+            files = [(os.path.abspath(f), base + '/' + os.path.relpath(f, match).replace(os.sep, '/')) for f in paths]
+        else:
+            files = [(os.path.abspath(match), os.path.split(os.path.abspath(match))[1])]
+        for path, name in files:
+            if name in names or name == MANIFEST_FILENAME:
+                raise Exception('Two release files would be stored as %s' % name)
+            names.add(name)
+            retval.append((path, name))
+    return retval
+
+def hash_file(path):
+    'Return the size, mtime and SHA-256 digest of the file, read in chunks'
+    import hashlib
+    st = os.stat(path)
+    h = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        while True:
+            chunk = fp.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+    return st.st_size, st.st_mtime, h.hexdigest()
+
+def release_format(settings):
+    'Return the bundle format and compression level set in the release settings, as a tuple (format, level)'
+    format = settings['release'].get('format', 'zip')
+    if format not in BUNDLE_FORMATS:
+        raise Exception('Unknown release format: "%s" Valid formats are: %s' % (format, ', '.join(sorted(BUNDLE_FORMATS))))
+    level = settings['release'].get('compression_level', DEFAULT_COMPRESSION_LEVEL)
+    if not isinstance(level, int) or not 0 <= level <= 9:
+        raise Exception('The compression level must be a number from 0 to 9, not %s' % level)
+    return format, level
+
+def read_chunks(path):
+    'Read the file in chunks of COMPRESS_CHUNK_SIZE.  Yield tuples (data, last), with a single empty chunk for an empty file.'
+    with open(path, 'rb') as fp:
+        data = fp.read(COMPRESS_CHUNK_SIZE)
+        while True:
+            next = fp.read(COMPRESS_CHUNK_SIZE)
+            yield data, not next
+            if not next:
+                break
+            data = next
+
+def deflate_chunk(data, level, last):
+    'Deflate a chunk on its own, ending on a byte boundary so that chunks can be concatenated into one raw deflate stream'
+    import zlib
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_FULL_FLUSH)
+
+class ParallelDeflater(object):
+    '''
+    Deflates chunks of data independently on a thread pool (as pigz does), at the cost of resetting the compression
+    dictionary at each chunk.  The results are passed to write(compressed, data, last, context) in the order the chunks
+    were submitted, and at most depth chunks are held in memory at once.
+    '''
+    def __init__(self, pool, level, write, depth):
+        self.pool = pool
+        self.level = level
+        self.write = write
+        self.depth = depth
+        self.pending = collections.deque()
+
+    def submit(self, data, last, context=None):
+        self.pending.append((self.pool.apply_async(deflate_chunk, (data, self.level, last)), data, last, context))
+        if len(self.pending) >= self.depth:
+            self.write_next()
+
+    def write_next(self):
+        result, data, last, context = self.pending.popleft()
+        self.write(result.get(), data, last, context)
+
+    def flush(self):
+        while self.pending:
+            self.write_next()
+
+class ZipBundle(object):
+    '''
+    Zip (ZIP64) bundle whose members are deflated in independent chunks on a thread pool, or stored when level is 0.
+    The chunks of all the members go through one pipeline, so many small files keep the pool as busy as one large file.
+    '''
+    def __init__(self, fp, level, pool, depth):
+        import zipfile
+        self.zip = zipfile.ZipFile(fp, 'w', zipfile.ZIP_DEFLATED if level else zipfile.ZIP_STORED, allowZip64=True)
+        self.deflater = ParallelDeflater(pool, level, self.write_chunk, depth) if level else None
+        self.current = None
+
+    def add(self, path, name):
+        import zipfile
+        st = os.stat(path)
+        zinfo = zipfile.ZipInfo(name, time.localtime(st.st_mtime)[0:6])
+        zinfo.external_attr = (st.st_mode & 0xFFFF) << 16L
+        zinfo.compress_type = self.zip.compression
+        # Same test as ZipFile.write, the header must have the same size when it is rewritten with the final sizes
+        member = (zinfo, st.st_size * 1.05 > zipfile.ZIP64_LIMIT)
+        for data, last in read_chunks(path):
+            if self.deflater:
+                self.deflater.submit(data, last, member)
+            else:
+                self.write_chunk(data, data, last, member)
+
+    def write_chunk(self, compressed, data, last, member):
+        'Write a compressed chunk of a member, writing its local header first and updating the header after its last chunk'
+        import zlib
+        fp = self.zip.fp
+        zinfo, zip64 = member
+        if zinfo is not self.current:
+            self.current = zinfo
+            zinfo.header_offset = fp.tell()
+            zinfo.CRC = zinfo.compress_size = zinfo.file_size = 0
+            self.zip._writecheck(zinfo)
+            self.zip._didModify = True
+            fp.write(zinfo.FileHeader(zip64))
+        fp.write(compressed)
+        zinfo.CRC = zlib.crc32(data, zinfo.CRC) & 0xffffffff
+        zinfo.compress_size += len(compressed)
+        zinfo.file_size += len(data)
+        if last:
+            # Same as ZipFile.write: rewrite the local header now that the sizes and CRC are known
+            position = fp.tell()
+            fp.seek(zinfo.header_offset)
+            fp.write(zinfo.FileHeader(zip64))
+            fp.seek(position)
+            self.zip.filelist.append(zinfo)
+            self.zip.NameToInfo[zinfo.filename] = zinfo
+
+    def add_data(self, name, data):
+        if self.deflater:
+            self.deflater.flush()
+        self.zip.writestr(name, data)
+
+    def close(self):
+        if self.deflater:
+            self.deflater.flush()
+        self.zip.close()
+
+class ParallelGzipFile(object):
+    'Write-only gzip stream, deflated in independent chunks on a thread pool.  The result is a single gzip member.'
+    def __init__(self, fp, level, pool, depth):
+        import struct
+        self.fp = fp
+        self.deflater = ParallelDeflater(pool, level, lambda compressed, data, last, context: fp.write(compressed), depth)
+        self.buffer = []
+        self.buffered = 0
+        self.crc = 0
+        self.size = 0
+        fp.write('\x1f\x8b\x08\x00' + struct.pack('<I', int(time.time())) + ('\x02' if level == 9 else '\x00') + '\xff')
+
+    def write(self, data):
+        import zlib
+        self.crc = zlib.crc32(data, self.crc) & 0xffffffff
+        self.size += len(data)
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= COMPRESS_CHUNK_SIZE:
+            self.submit(False)
+
+    def submit(self, last):
+        data = ''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        self.deflater.submit(data, last)
+
+    def close(self):
+        import struct
+        self.submit(True)
+        self.deflater.flush()
+        self.fp.write(struct.pack('<II', self.crc, self.size & 0xffffffff))
+
+class XzFile(object):
+    '''
+    Write-only xz stream.  The xz tool is used when it is installed, since it compresses on all cores (-T0),
+    otherwise the lzma module (or its backport for Python 2) compresses on this thread.
+    '''
+    def __init__(self, fp, level):
+        import subprocess
+        self.process = None
+        xz = find_executable('xz')
+        if xz:
+            self.process = subprocess.Popen([xz, '-T0', '-%d' % level, '-c'], stdin=subprocess.PIPE, stdout=fp)
+            return
+        try:
+            import lzma
+        except ImportError:
+            try:
+                from backports import lzma
+            except ImportError:
+                raise Exception('The tar.xz release format needs the xz tool or the backports.lzma module.')
+        self.fp = fp
+        self.compressor = lzma.LZMACompressor(preset=level)
+
+    def write(self, data):
+        if self.process:
+            self.process.stdin.write(data)
+        else:
+            self.fp.write(self.compressor.compress(data))
+
+    def close(self):
+        if self.process:
+            self.process.stdin.close()
+            if self.process.wait() != 0:
+                raise Exception('xz failed with error code %d' % self.process.returncode)
+        else:
+            self.fp.write(self.compressor.flush())
+
+class TarBundle(object):
+    'Tar bundle (pax format), streamed through a compressor for the tar.gz and tar.xz formats'
+    def __init__(self, fp, format, level, pool, depth):
+        import tarfile
+        if format == 'tar.gz':
+            self.stream = ParallelGzipFile(fp, level, pool, depth)
+        elif format == 'tar.xz':
+            self.stream = XzFile(fp, level)
+        else:
+            self.stream = None
+        self.tar = tarfile.open(fileobj=self.stream or fp, mode='w|', format=tarfile.PAX_FORMAT)
+
+    def add(self, path, name):
+        self.tar.add(path, arcname=name, recursive=False)
+
+    def add_data(self, name, data):
+        import tarfile
+        from cStringIO import StringIO
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = time.time()
+        info.mode = 0644
+        self.tar.addfile(info, StringIO(data))
+
+    def close(self):
+        self.tar.close()
+        if self.stream:
+            self.stream.close()
+
+def release_storage(settings):
+    'Return how releases are stored on the release branch: as one bundle per release, or as a tree of the release files'
+    storage = settings['release'].get('storage', 'bundle')
+    if storage not in RELEASE_STORAGE_MODES:
+        raise Exception('Unknown release storage: "%s" Valid modes are: %s' % (storage, ', '.join(RELEASE_STORAGE_MODES)))
+    return storage
+
+@traced('phase')
+def do_write_bundle(settings, files, dir='.', manifest=None):
+    '''
+    Write the files, given as (path, archive name) tuples, to a bundle of the release format, streamed to a temporary file in dir.
+    If given, manifest is called once the files are written, and the dict it returns is stored in the bundle as MANIFEST.json.
+    Return the path to the temporary file, which the caller is expected to move into place.
+    '''
+    import tempfile, multiprocessing
+    from multiprocessing.pool import ThreadPool
+    format, level = release_format(settings)
+    threads = settings['release'].get('compression_threads') or multiprocessing.cpu_count()
+    pool = ThreadPool(threads)
+    fd, bundle = tempfile.mkstemp(prefix='.gitmake-bundle-', suffix=BUNDLE_FORMATS[format], dir=dir)
+    start = time.time()
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            if format == 'zip':
+                writer = ZipBundle(fp, level, pool, 2 * threads)
+            else:
+                writer = TarBundle(fp, format, level, pool, 2 * threads)
+            for path, name in files:
+                writer.add(path, name)
+                message("Releasing this file: %s" % path)
+            if manifest:
+                writer.add_data(MANIFEST_FILENAME, json.dumps(manifest(), indent=4, sort_keys=True))
+            writer.close()
+    except:
+        os.remove(bundle)
+        raise
+    finally:
+        pool.close()
+    total = sum(os.path.getsize(path) for path, name in files)
+    compressed = os.path.getsize(bundle)
+    elapsed = max(time.time() - start, 1e-6)
+    # Plain tar bundles aren't compressed, so the level means nothing for them
+    kind = format if format == 'tar' else '%s (level %d)' % (format, level)
+    message('Bundled %d files as %s, %0.2fMB to %0.2fMB (ratio %0.2f) in %0.2fs (%0.2fMB/s, peak RSS %0.2fMB)' % (
+        len(files), kind, total/1e6, compressed/1e6, float(total)/max(compressed, 1), elapsed, total/1e6/elapsed, peak_rss()/1e6))
+    return bundle
+
+@traced('phase')
+def do_collect_release_data_here(args, settings, dir='.', version=None):
+    '''
+    Collect all the specified files into a bundle, streamed to a temporary file in dir.  The files are hashed on a thread pool
+    while they are compressed, and a manifest is stored in the bundle.  With tree storage, the temporary file is instead a JSON
+    listing of the files and the manifest, which do_commit_release_here() stores as a tree.
+    Return the path to the temporary file, which the caller is expected to move into place.
+    '''
+    import tempfile
+    from multiprocessing.pool import ThreadPool
+    storage = release_storage(settings)
+    files = expand_release_files(settings['release']['files'])
+    pool = ThreadPool(settings['release'].get('hash_threads') or None)
+    hashes = pool.map_async(hash_file, [path for path, name in files])
+    def manifest():
+        retval = {'files':[]}
+        if version:
+            retval['version'] = version.tag
+        for (path, name), (size, mtime, digest) in zip(files, hashes.get()):
+            retval['files'].append({'name':name, 'size':size, 'mtime':mtime, 'sha256':digest})
+        return retval
+    try:
+        if storage == 'bundle':
+            return do_write_bundle(settings, files, dir, manifest)
+        fd, listing = tempfile.mkstemp(prefix='.gitmake-release-', suffix='.json', dir=dir)
+        with os.fdopen(fd, 'w') as fp:
+            json.dump({'files':[[os.path.abspath(path), name] for path, name in files], 'manifest':manifest()}, fp)
+        message('Listed %d files to store in the release tree' % len(files))
+        return listing
+    finally:
+        pool.close()
+
+@contextmanager
+def branch_lock(git_dir, branch):
+    '''
+    Hold an exclusive lock on a branch of the repos while the block runs, so that only one gitmake process at a time
+    allocates versions on it.  The locks are files in .git/gitmake/locks, so different branches can be tagged in parallel.
+    '''
+    if not git_dir:
+        yield
+        return
+    path = os.path.join(git_dir, 'gitmake', 'locks', branch.replace('/', '%2F') + '.lock')
+    with file_lock(path, 'tagging branch %s' % branch):
+        yield
+
+@contextmanager
+def file_lock(path, what):
+    'Hold an exclusive lock on the file at path while the block runs.  If another process holds it, say that it is busy with what.'
+    import fcntl
+    if not os.path.isdir(os.path.dirname(path)):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass
+    with open(path, 'a') as fp:
+        try:
+            fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            message('Waiting for another gitmake process %s' % what)
+            with trace_span('wait for %s' % os.path.basename(path), 'lock'):
+                fcntl.flock(fp, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+@traced('phase')
+def do_create_tag_here(new_version, version_file, remote=True, msg='', settings=None):
+    '''
+    Commit the version file and tag the commit with the new version.  With remote operations enabled the tag is pushed right
+    away, and if someone else has already pushed that version the commit and tag are dropped and the next patch version
+    is tried instead.  Return the version that was tagged.
+    '''
+    import random
     repos = GitRepos(remote=remote)
 
 
     # TODO : CHECK FOR A CLEAN REPOS. DON'T ADD AND COMMIT A VERSION FILE IF THERE'S LOCAL CHANGES
 
-    message('Committing version file "%s" for tag %s.' % (version_file, new_version.tag))
-    save_version_file(new_version, version_file)
-    repos.add(version_file)
-    repos.commit(msg='Tag commit for %s generated by gitmake.py' % new_version.tag)
+    for attempt in range(TAG_ATTEMPTS):
+        message('Committing version file "%s" for tag %s.' % (version_file, new_version.tag))
+        save_version_file(new_version, version_file, settings)
+        repos.add(version_file)
+        repos.commit(msg='Tag commit for %s generated by gitmake.py' % new_version.tag)
 
-    message('Creating a commit and tag for %s' % new_version.tag)
-    repos.tag(new_version.tag)
-    repos.push(new_version.tag)
+        message('Creating a commit and tag for %s' % new_version.tag)
+        if not repos.tag(new_version.tag):
+            repos.drop_last_commit()
+            if not repos.resolve('refs/tags/%s' % new_version.tag):
+                error("Couldn't create tag %s." % new_version.tag)
+                sys.exit(1)
+            message('%s has already been tagged.  Trying the next patch version.' % new_version.tag)
+        elif repos.push_new_ref('refs/tags/%s' % new_version.tag):
+            break
+        else:
+            message('%s has already been tagged on the remote.  Trying the next patch version.' % new_version.tag)
+            # Back off for a random time, so that processes racing for the same versions spread out
+            time.sleep(random.uniform(0, 0.05 * min(attempt + 1, 10)))
+            repos.delete_tag(new_version.tag)
+            repos.drop_last_commit()
+            repos.fetch_tags('v*-%s' % new_version.branch)
+        taken = repos.get_version_set().next_patch(new_version.branch, new_version.major, new_version.minor)
+        new_version = max(taken, new_version.rev_patch())
+    else:
+        error('Giving up on tagging after %d attempts.' % TAG_ATTEMPTS)
+        sys.exit(1)
 
     message('Tag %s created successfully.' % new_version.tag)
     return new_version
 
-def do_get_version_increment_here(args):
+@traced('phase')
+def do_get_revision_level(args):
+    'Return the revision level to tag at: m (major), i (minor) or p (patch), from the command line or else by asking for it'
+    if args.major:
+        return 'm'
+    if args.minor:
+        return 'i'
+    if args.patch:
+        return 'p'
+    choice = 'x'
+    while choice not in 'mip':
+        choice = (raw_input('Revision level for tag? ([m]ajor, m[i]nor, [p]atch): ') + ' ')[0].lower()
+    return choice
+
+def do_get_version_increment_here(args, level=None):
+    'Return the next version of the current branch at the revision level given (asking for it if there is none)'
     # Current branch is assumed to be the one we want to tag
     repos = GitRepos()
     git_branch = repos.get_current_branch()
-    git_tags = repos.get_tags(git_branch)
     
     # Get the latest released version
-    if git_tags:
-        current_version = git_tags[-1]
+    current_version = repos.get_latest_version(git_branch)
+    if current_version:
         message('Current version is %s.' % (current_version.tag))
     else:
         message('No previous releases.')
         current_version = VersionInfo(branch=git_branch) # v0.0.0-branch
     
     # Prompt for a new version if none was specified on the command line
-    choice = 'x'
-    if not args.major and not args.minor and not args.patch:
-        while choice not in 'mip':
-            choice = (raw_input('Revision level for tag? ([m]ajor, m[i]nor, [p]atch): ') + ' ')[0].lower()
+    level = level or do_get_revision_level(args)
         
     # Increment the version number
-    if args.major or choice == 'm':
+    if level == 'm':
         new_version = current_version.rev_major(git_branch)
-    elif args.minor or choice == 'i':
+    elif level == 'i':
         new_version = current_version.rev_minor(git_branch)
-    elif args.patch or choice == 'p':
+    elif level == 'p':
         new_version = current_version.rev_patch(git_branch)
     else:
         raise Exception("Should never get here.")
     return new_version
 
+def get_local_repos(settings):
+    'Return a tuple (git dir, url) for the repos here.  The git dir is None when not in a git repos.'
+    git_dir = find_git_dir(os.curdir)
+    url = GitRepos().url if git_dir else settings['settings'].get('url')
+    return git_dir, url
+
+@traced('phase')
+def do_prepare_release_here(args, settings, version, git_dir, url):
+    '''
+    Check out and build the tagged version in the current (empty) directory and bundle the release files.
+    Return the absolute path of the bundle, or None if the build failed.
+    '''
+    do_checkout_here(args, settings, version, git_dir, url)
+    if not do_cached_build_here(args, settings):
+        return None
+    return os.path.abspath(do_collect_release_data_here(args, settings, version=version))
+
+def release_entry_name(settings, version):
+    'Return the name of the release of version in the tree of the release branch'
+    if release_storage(settings) == 'tree':
+        return version.tag
+    return settings['release']['filename'] + '-' + version.tag + BUNDLE_FORMATS[release_format(settings)[0]]
+
+def write_release_tree(repos, listing):
+    '''
+    Write the files in a release listing (made by do_collect_release_data_here with tree storage) and their manifest to
+    the object database of the repos, as a tree with the same layout as a bundle.  Return the hash of the tree.
+    '''
+    with open(listing) as fp:
+        data = json.load(fp)
+    root = {MANIFEST_FILENAME:('100644', repos.write_blob(data=json.dumps(data['manifest'], indent=4, sort_keys=True)))}
+    blobs = repos.write_blobs([path for path, name in data['files']])
+    for (path, name), blob in zip(data['files'], blobs):
+        node = root
+        parts = name.split('/')
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = ('100755' if os.stat(path).st_mode & 0111 else '100644', blob)
+    def write(node):
+        return repos.write_tree([('040000', 'tree', write(value), name) if isinstance(value, dict) else (value[0], 'blob', value[1], name)
+                                 for name, value in node.items()])
+    return write(root)
+
+@traced('phase')
+def do_commit_release_here(args, settings, version, bundle):
+    '''
+    Commit the bundle to the release branch of the repos here, creating the branch if needed.  The commit is
+    built directly in the object database, so the working copy is left alone.  It is not pushed.  Return True on success.
+    '''
+    repos = GitRepos(remote=args.remote)
+    ref = 'refs/heads/%s' % RELEASE_BRANCH_NAME
+
+    # create a release branch if needed
+    local = repos.resolve(ref)
+    parent = local or repos.resolve('refs/remotes/origin/%s' % RELEASE_BRANCH_NAME)
+    if not parent:
+        create_release_branch = True
+        if args.confirm:
+            create_release_branch = confirm('No branch exists for releases.  Create one?', True)
+        if not create_release_branch:
+            os.remove(bundle)
+            error('No release because there is no release branch.')
+            return False
+        parent = local = repos.create_orphan_branch(RELEASE_BRANCH_NAME)
+
+    storage = release_storage(settings)
+    filename = release_entry_name(settings, version)
+    entries = repos.read_tree(parent)
+    if filename in [entry[3] for entry in entries]:
+        os.remove(bundle)
+        error('Release %s already exists.' % filename)
+        return False
+
+    # save if all looks good, write the commit straight to the object database
+    if storage == 'tree':
+        message('Saving release files under %s/' % filename)
+        entry = ('040000', 'tree', write_release_tree(repos, bundle), filename)
+    else:
+        message('Saving release bundle as %s' % filename)
+        entry = ('100644', 'blob', repos.write_blob(bundle), filename)
+    os.remove(bundle)
+    message('Committing release %s to repository' % version.tag)
+    tree = repos.write_tree(entries + [entry])
+    commit = repos.commit_tree(tree, [parent], msg='Release of %s' % version.tag)
+    repos.update_ref(ref, commit, old=local or '')
+    return True
+
+@traced('phase')
 def do_release(args, settings, release_version):
-    # Get the url of the current repos
-    url = GitRepos().url
+    # Get the url and object store of the current repos
+    git_dir, url = get_local_repos(settings)
 
     # Create a build dir and go there
     build_dir = do_make_build_dir_here(args, settings) 
     with cd(build_dir):
         
-        # clone the tag to the fresh build directory
-        do_clone_here(url, release_version)
+        # materialize the tag in the fresh build directory and do a build.  don't release it if unsuccessful
+        bundle = do_prepare_release_here(args, settings, release_version, git_dir, url)
+        if not bundle:
+            error('No release because build was unsuccessful.')
+            sys.exit(1)
+
+        # The release branch may not have been fetched (in a worktree, say), and committing to a stale one would be rejected
         repos = GitRepos(remote=args.remote)
-        
-        # do a build.  don't release it if unsuccessful
-        ok_to_release = do_build_here(settings['build']['build_command'])
-
-        if ok_to_release:
-            # create a release branch if needed
-            all_branches = repos.get_branches()
-            if RELEASE_BRANCH_NAME not in all_branches and 'remotes/origin/%s' % RELEASE_BRANCH_NAME not in all_branches:
-                create_release_branch = True
-                if args.confirm:
-                    create_release_branch = confirm('No branch exists for releases.  Create one?', True)
-                if create_release_branch:
-                    repos.create_orphan_branch(RELEASE_BRANCH_NAME)
-           
-            # create bundle
-            s = do_collect_release_data_here(args, settings)
-            
-            filename = settings['release']['filename'] + '-' + release_version.tag + '.zip'
-            repos.reset()
-            repos.checkout(RELEASE_BRANCH_NAME)
-            if os.path.exists(filename):
-                error('Release bundle %s already exists.' % filename)
-                sys.exit(1)
+        do_sync_release_branch_here(repos)
+        if not do_commit_release_here(args, settings, release_version, bundle):
+            sys.exit(1)
+        repos.push(RELEASE_BRANCH_NAME)
 
-            # save if all looks good, add, commit push
-            message('Saving release bundle as %s' % filename)
-            with open(filename, 'wb') as fp:
-                fp.write(s)
-            message('Committing release %s to repository' % release_version.tag)
-            repos.add(filename)
-            repos.commit(msg='Release of %s' % release_version.tag)
-            message('Pushing commit to remote')
-            repos.push(RELEASE_BRANCH_NAME)
-            repos.checkout('master')
-        else:
-            error('No release because build was unsuccessful.')
+@traced('phase')
+def do_create_tag_commit_here(repos, version, version_file, head, settings=None):
+    '''
+    Create the commit to tag for version: head with the version file updated.  The commit is built in the object
+    database, so neither the working copy nor the branch are touched.  Return the hash of the commit.
+    '''
+    import tempfile
+    message('Creating the tag commit for %s' % version.tag)
+    fd, tmp = tempfile.mkstemp(prefix='.gitmake-version-', suffix=os.path.splitext(version_file)[1], dir='.')
+    os.close(fd)
+    try:
+        save_version_file(version, tmp, settings)
+        blob = repos.write_blob(tmp)
+    finally:
+        os.remove(tmp)
+    path = repos.get_prefix() + version_file.replace(os.sep, '/')
+    tree = repos.replace_in_tree(head, path, blob)
+    return repos.commit_tree(tree, [head], msg='Tag commit for %s generated by gitmake.py' % version.tag)
+
+@traced('phase')
+def do_pipeline_build_and_tag_here(args, settings, repos, git_dir):
+    '''
+    The build and tag stages of the pipeline: build the commit to tag in a clean worktree, then tag it and push the tag.
+    If the version was taken in the meantime, the next patch version is committed and built instead.
+    Return the state of the pipeline after the tag stage.
+    '''
+    version_file = settings['build']['version_file']
+    worktree = os.path.abspath(os.path.join(settings['settings']['build_directory'], 'pipeline'))
+    head = repos.resolve('HEAD')
+    prefix = repos.get_prefix()
+    message('Getting new version number')
+    new_version = do_get_version_increment_here(args)
+    for attempt in range(TAG_ATTEMPTS):
+        commit = do_create_tag_commit_here(repos, new_version, version_file, head, settings)
+        do_remove_build_dir(worktree)
+        message('Adding worktree for the tag commit of %s' % new_version.tag)
+        rc, output = do('git worktree add --detach "%s" %s' % (worktree, commit))
+        if rc != 0:
+            error('Cannot add worktree: %s' % output.strip())
+            sys.exit(1)
+        with cd(os.path.join(worktree, prefix)):
+            built = do_cached_build_here(args, settings)
+        if not built:
+            error('Not tagging %s because the build failed.' % new_version.tag)
+            do_remove_build_dir(worktree)
+            sys.exit(1)
+
+        with branch_lock(git_dir, new_version.branch):
+            repos.invalidate()
+            if not repos.has_version(new_version) and repos.tag(new_version.tag, commit=commit):
+                if repos.push_new_ref('refs/tags/%s' % new_version.tag):
+                    break
+                repos.delete_tag(new_version.tag)
+        message('%s has already been tagged.  Building the next patch version.' % new_version.tag)
+        if args.remote:
+            repos.fetch_tags('v*-%s' % new_version.branch)
+        taken = repos.get_version_set().next_patch(new_version.branch, new_version.major, new_version.minor)
+        new_version = max(taken, new_version.rev_patch())
+    else:
+        error('Giving up on tagging after %d attempts.' % TAG_ATTEMPTS)
+        sys.exit(1)
+    message('Tag %s created successfully.' % new_version.tag)
+
+    # Put the tag commit on the branch, as tagging without the pipeline does.  It only differs from HEAD by the version file, so
+    # that is the only file of the working copy to update, and local changes to the others (or to the version file) don't matter.
+    state = {'tag':new_version.tag, 'commit':commit, 'worktree':worktree, 'prefix':prefix, 'stage':'tag'}
+    try:
+        repos.update_ref('HEAD', commit, old=head)
+    except Exception:
+        state['branch_error'] = 'The branch has moved since the pipeline started, so the tag commit of %s is not on it.' % new_version.tag
+        error(state['branch_error'])
+        return state
+    with cd(repos.dir):
+        rc, output = do('git checkout %s -- "%s"' % (commit, version_file), show=False)
+    if rc != 0:
+        state['branch_error'] = "The tag commit of %s is on the branch, but the version file couldn't be updated: %s" % (new_version.tag, output.strip())
+        error(state['branch_error'])
+    return state
+
+def do_sync_release_branch_here(repos, discard=None):
+    '''
+    Bring the local release branch up to date with the remote before committing a release to it.  discard is a release
+    commit made by an earlier attempt that was never pushed, which is dropped so that the release is committed again.
+    '''
+    ref = 'refs/heads/%s' % RELEASE_BRANCH_NAME
+    if repos.remote:
+        with cd(repos.dir):
+            do('git fetch -q origin +%s:refs/remotes/origin/%s' % (ref, RELEASE_BRANCH_NAME), show=False)
+        repos.invalidate()
+    local = repos.resolve(ref)
+    remote = repos.resolve('refs/remotes/origin/%s' % RELEASE_BRANCH_NAME)
+    if discard and local == discard:
+        message('Dropping the unpushed release commit %s' % discard)
+        local = repos.resolve(discard + '^')
+        repos.update_ref(ref, local, old=discard)
+    if local and remote and local != remote and repos.is_ancestor(local, remote):
+        repos.update_ref(ref, remote, old=local)
+        local = remote
+    return local or remote
+
+def save_pipeline_state(path, state):
+    with atomic_write(path) as fp:
+        json.dump(state, fp, indent=4, sort_keys=True)
+
+@traced('phase')
+def do_tag_pipeline(args, settings, resume=False):
+    '''
+    Tag and release with a single build.  The stages are:
+      build   - create the commit to tag (HEAD with the new version file) and build it in a clean worktree
+      tag     - tag that commit and push the tag
+      bundle  - collect the release files built in the worktree
+      release - commit the bundle to the release branch
+      push    - push the release branch
+    Once the tag stage is done, the state of the pipeline is kept in .git/gitmake/pipeline.json, so that a run that failed
+    later on can be resumed from the bundle stage (or from the release stage, if the bundle was made) without a rebuild.
+    '''
+    repos = GitRepos(remote=args.remote)
+    git_dir = find_git_dir(repos.key)
+    if not git_dir:
+        error('The tag pipeline needs a git repos.')
+        sys.exit(1)
+    path = os.path.join(git_dir, 'gitmake', 'pipeline.json')
+    if resume:
+        try:
+            with open(path) as fp:
+                state = json.load(fp)
+        except IOError:
+            error('There is no tag pipeline to resume.')
             sys.exit(1)
+        message('Resuming the tag pipeline of %s after the %s stage' % (state['tag'], state['stage']))
+    else:
+        if os.path.exists(path):
+            with open(path) as fp:
+                error('The tag pipeline of %s did not complete.  Resume it with --resume, or delete %s.' % (json.load(fp)['tag'], path))
+            sys.exit(1)
+        do_cleanup(args, settings)
+        state = do_pipeline_build_and_tag_here(args, settings, repos, git_dir)
+        save_pipeline_state(path, state)
+    version = VersionInfo.from_string(state['tag'])
+
+    if state['stage'] == 'tag':
+        if not os.path.isdir(state['worktree']):
+            error('The build of %s is gone.  Release it with: release --from-tag %s' % (version.tag, version.tag))
+            sys.exit(1)
+        with cd(os.path.join(state['worktree'], state['prefix'])):
+            state['bundle'] = do_collect_release_data_here(args, settings, dir=os.path.dirname(path), version=version)
+        state['stage'] = 'bundle'
+        save_pipeline_state(path, state)
+
+    parent = do_sync_release_branch_here(repos, state.get('release_commit'))
+    if parent and release_entry_name(settings, version) in [entry[3] for entry in repos.read_tree(parent)]:
+        message('Release %s is already on the release branch.' % version.tag)
+    else:
+        # The bundle is kept until the release is pushed, in case the push fails
+        import shutil
+        copy = state['bundle'] + '.commit'
+        shutil.copyfile(state['bundle'], copy)
+        if not do_commit_release_here(args, settings, version, copy):
+            sys.exit(1)
+        state.update(stage='release', release_commit=repos.resolve('refs/heads/%s' % RELEASE_BRANCH_NAME))
+        save_pipeline_state(path, state)
+        repos.push(RELEASE_BRANCH_NAME)
+        if not do_push_queued():
+            error('Resume the release of %s with: tag --resume' % version.tag)
+            sys.exit(1)
+
+    os.remove(state['bundle'])
+    do_remove_build_dir(state['worktree'])
+    os.remove(path)
+    message('Tagged and released %s with a single build.' % version.tag)
+    if 'branch_error' in state:
+        error(state['branch_error'])
+        sys.exit(1)
+
+def resolve_versions(tags):
+    'Turn a list of tags, tag patterns (such as v1.2.*-master) and tag ranges (A..B) into a sorted list of versions'
+    import fnmatch, glob
+    versions = {}
+    all_versions = None
+    for tag in tags:
+        if glob.has_magic(tag) or '..' in tag:
+            if all_versions is None:
+                all_versions = GitRepos().get_version_set()
+            if '..' in tag:
+                matches = all_versions.select(tag)
+            else:
+                matches = [v for v in all_versions if fnmatch.fnmatchcase(v.tag, tag)]
+            if not matches:
+                error('No tags match %s' % tag)
+        else:
+            matches = [VersionInfo.from_string(tag)]
+        for version in matches:
+            versions[version.tag] = version
+    return sorted(versions.values())
+
+@traced('phase')
+def tag_job(job):
+    'Build (and bundle, if releasing) one version in its own build directory.  Runs in a worker process of do_tag_jobs.'
+    args, settings, version, git_dir, url, dir, release = job
+    result = {'tag':version.tag, 'dir':dir, 'built':False, 'bundle':None, 'released':False, 'error':None}
+    if tracer:
+        # Only send back the spans recorded in this worker
+        tracer.spans = []
+    start = time.time()
+    try:
+        os.makedirs(dir)
+        with cd(dir):
+            if release:
+                result['bundle'] = do_prepare_release_here(args, settings, version, git_dir, url)
+                result['built'] = result['bundle'] is not None
+            else:
+                do_checkout_here(args, settings, version, git_dir, url)
+                result['built'] = do_cached_build_here(args, settings)
+    except SystemExit:
+        result['error'] = 'aborted'
+    except Exception, e:
+        result['error'] = str(e)
+    result['time'] = time.time() - start
+    result['spans'] = tracer.spans if tracer else []
+    return result
+
+@traced('phase')
+def do_tag_jobs(args, settings, versions, release=False):
+    '''
+    Build each of the versions in its own directory under the build directory, on a pool of --jobs worker processes.
+    Return a list of results (dicts) in the same order as the versions.
+    '''
+    import multiprocessing
+    git_dir, url = get_local_repos(settings)
+    build_dir = do_make_build_dir_here(args, settings)
+    jobs = [(args, settings, version, git_dir, url, os.path.abspath(os.path.join(build_dir, version.tag)), release) for version in versions]
+    processes = args.jobs or min(len(jobs), multiprocessing.cpu_count())
+    message('Building %d tags with %d workers' % (len(jobs), processes))
+    pool = multiprocessing.Pool(processes)
+    try:
+        # A timeout keeps the wait interruptible with Ctrl-C
+        results = pool.map_async(tag_job, jobs, chunksize=1).get(0xFFFFFF)
+    finally:
+        pool.close()
+        pool.join()
+    if tracer:
+        for result in results:
+            tracer.spans.extend(result['spans'])
+    return results
+
+@traced('phase')
+def do_release_many(args, settings, versions):
+    '''
+    Release several versions.  The versions are built and bundled in parallel, and the bundles are then
+    committed to the release branch one after another, in the build directory of the first successful
+    build, and pushed once, before the summary is shown, so that the releases that succeeded are pushed
+    even if others failed.
+    '''
+    results = do_tag_jobs(args, settings, versions, release=True)
+    writer = None
+    for version, result in zip(versions, results):
+        if not result['bundle']:
+            continue
+        if not writer:
+            writer = result['dir']
+            with cd(writer):
+                do_sync_release_branch_here(GitRepos(remote=args.remote))
+        with cd(writer):
+            result['released'] = do_commit_release_here(args, settings, version, result['bundle'])
+    if writer and any(result['released'] for result in results):
+        with cd(writer):
+            GitRepos(remote=args.remote).push(RELEASE_BRANCH_NAME)
+        if not do_push_queued():
+            for result in results:
+                if result['released']:
+                    result.update(released=False, error='not pushed')
+    return results
+
+def show_job_summary(results, release=False):
+    'Print a line per tag with the outcome of its build (and release).  Return True if all of them succeeded.'
+    message('Summary:')
+    ok = True
+    for result in results:
+        if result['error']:
+            status = 'error: %s' % result['error']
+        elif not result['built']:
+            status = 'build failed'
+        elif release and not result['released']:
+            status = 'release failed'
+        else:
+            status = 'released' if release else 'built'
+        ok = ok and status in ('built', 'released')
+        message('  %-24s %-32s %8.1fs' % (result['tag'], status, result['time']))
+    return ok
+
+def normalize_update_url(url):
+    'Turn a local path or file:// URL into a file:// URL of the absolute path, so that all the ways of naming a file compare equal'
+    import urllib, urlparse
+    if '://' not in url:
+        return 'file://' + os.path.abspath(url)
+    parsed = urlparse.urlparse(url)
+    if parsed.scheme == 'file':
+        return 'file://' + os.path.abspath(urllib.url2pathname(parsed.path))
+    return url
+
+def open_update_source(url, meta):
+    '''
+    Open the update bundle at url (an http(s) URL, or a file:// URL from normalize_update_url) for reading.  meta holds the
+    validators (ETag, Last-Modified) of the cached copy, if there is one.  Return a tuple (file object or None if the cached
+    copy is still current, new validators).
+    '''
+    import urllib2
+    if url.startswith('file://'):
+        st = os.stat(url[len('file://'):])
+        validators = {'mtime':st.st_mtime, 'size':st.st_size}
+        if all(meta.get(k) == v for k, v in validators.items()):
+            return None, meta
+        return open(url[len('file://'):], 'rb'), validators
+    request = urllib2.Request(url)
+    if meta.get('etag'):
+        request.add_header('If-None-Match', meta['etag'])
+    if meta.get('last_modified'):
+        request.add_header('If-Modified-Since', meta['last_modified'])
+    try:
+        fp = urllib2.urlopen(request)
+    except urllib2.HTTPError, e:
+        if e.code == 304:
+            return None, meta
+        raise
+    return fp, {'etag':fp.info().getheader('ETag'), 'last_modified':fp.info().getheader('Last-Modified'),
+                'size':int(fp.info().getheader('Content-Length') or -1)}
+
+@traced('phase')
+def do_fetch_update(tag, source=None, sha256=None):
+    '''
+    Fetch the gitmake bundle for the tag into the update cache (unless the cached copy is still current) and return its path.
+    The bundle is streamed to disk and checked against the expected size and, if given, the SHA-256 digest.
+    '''
+    import hashlib, string, tempfile
+    url = normalize_update_url(string.Template(source or os.environ.get('GITMAKE_UPDATE_URL') or UPDATE_URL).substitute({'tag':tag}))
+    dir = cache_directory('updates', tag)
+    bundle = os.path.join(dir, 'gitmake.zip')
+    meta_path = os.path.join(dir, 'meta.json')
+    try:
+        with open(meta_path) as fp:
+            meta = json.load(fp)
+        if meta.get('url') != url or not os.path.isfile(bundle) or hash_file(bundle)[2] != meta.get('sha256'):
+            meta = {}
+    except (IOError, ValueError):
+        meta = {}
 
-def do_update(tag):
-    url = string.Template(UPDATE_URL).substitute({'tag':tag})
     message("Retrieving update from %s" % url)
-    fp = urllib2.urlopen(url)
-    s = fp.read()
-    fp.close()
-    message("Update is %0.2fkB" % (len(s)/1000.0))
-    z = zipfile.ZipFile(StringIO.StringIO(s))
-    #print z.namelist()
+    fp, validators = open_update_source(url, meta)
+    if fp is None:
+        message('Using cached update %s' % bundle)
+    else:
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+        fd, tmp = tempfile.mkstemp(prefix='.gitmake-update-', dir=dir)
+        h = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                while True:
+                    chunk = fp.read(HASH_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    h.update(chunk)
+                    out.write(chunk)
+                    size += len(chunk)
+            fp.close()
+            if validators.get('size', -1) not in (-1, size):
+                raise Exception('Update is truncated: got %d of %d bytes' % (size, validators['size']))
+            os.rename(tmp, bundle)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        message("Update is %0.2fkB" % (size/1000.0))
+        meta = dict(validators, url=url, sha256=h.hexdigest())
+        with open(meta_path, 'w') as fp:
+            json.dump(meta, fp)
+    if sha256 and meta['sha256'] != sha256.lower():
+        raise Exception('Update checksum mismatch: expected %s, got %s' % (sha256, meta['sha256']))
+    return bundle
+
+@traced('phase')
+def do_update(tag, source=None, sha256=None):
+    import shutil, tempfile, zipfile
+    bundle = do_fetch_update(tag, source, sha256)
+    z = zipfile.ZipFile(bundle)
+    bad = z.testzip()
+    if bad:
+        raise Exception('Update bundle is corrupt: %s' % bad)
     message('Extracting gitmake.py')
-    z.extract('gitmake.py')
+    fd, tmp = tempfile.mkstemp(prefix='.gitmake-', suffix='.py', dir='.')
+    with os.fdopen(fd, 'wb') as fp:
+        shutil.copyfileobj(z.open('gitmake.py'), fp)
+    # mkstemp creates the file readable by its owner only
+    try:
+        os.chmod(tmp, os.stat('gitmake.py').st_mode & 07777)
+    except OSError:
+        os.chmod(tmp, 0755)
+    os.rename(tmp, 'gitmake.py')
 
+@traced('phase')
 def command_init(args, settings):
     'Function called from the "init" command line'
     message("Initializing build environment")
     initialize_environment(args)
     message("Done.")
 
+@traced('phase')
 def command_build(args, settings):
     'Function called by the "build" command line'
     if args.tag:
-        cwd = os.curdir
+        versions = resolve_versions(args.tag)
+        if len(versions) > 1:
+            if not show_job_summary(do_tag_jobs(args, settings, versions)):
+                sys.exit(1)
+            return
+        git_dir, url = get_local_repos(settings)
         build_dir = do_make_build_dir_here(args, settings)
         with cd(build_dir):
-            do_clone_tag_here(args, settings, VersionInfo.from_string(args.tag))  
-            do_build_here(settings['build']['build_command'])
+            do_checkout_here(args, settings, versions[0], git_dir, url)
+            do_cached_build_here(args, settings)
     else:
-        save_version_file(VersionInfo(), settings['build']['version_file'])
-        do_build_here(settings['build']['build_command'])
+        # The commit time keeps the version file (and whatever depends on it) unchanged between local builds
+        if not save_version_file(VersionInfo(), settings['build']['version_file'], settings, timestamp='commit'):
+            message('Version file %s is up to date.' % settings['build']['version_file'])
+        do_cached_build_here(args, settings)
 
+@traced('phase')
 def command_tag(args, settings):
     'Function called by the "tag" command line'
+    if args.pipeline or args.resume:
+        do_tag_pipeline(args, settings, resume=args.resume)
+        return
     do_cleanup(args, settings)
     version_file = settings['build']['version_file'] 
     
     # Build first in order to determine if it's OK to tag
-    ok_to_tag = do_build_here(settings['build']['build_command'])
+    ok_to_tag = do_cached_build_here(args, settings)
     if not ok_to_tag and args.confirm:
         ok_to_tag = confirm("The build failed.  Are you sure you want to create a tag here? (y/N)", False)
     
     if ok_to_tag:
     
-        message('Getting new version number')
-        new_version = do_get_version_increment_here(args)
-        do_create_tag_here(new_version, version_file=version_file, remote=args.remote, msg=args.message) 
+        # Versions are allocated on one branch at a time, by all gitmake processes using this repos.  The revision level is
+        # asked for first, so that the others don't wait on the prompt.
+        level = do_get_revision_level(args)
+        repos = GitRepos()
+        with branch_lock(find_git_dir(repos.key), repos.get_current_branch()):
+            repos.invalidate()
+            message('Getting new version number')
+            new_version = do_get_version_increment_here(args, level)
+            new_version = do_create_tag_here(new_version, version_file=version_file, remote=args.remote, msg=args.message, settings=settings)
     
         if args.release:
             do_release(args, settings, new_version)
 
+@traced('phase')
 def command_release(args, settings):
-    new_version = VersionInfo.from_string(args.tag)
-    do_release(args, settings, new_version)
+    'Function called by the "release" command line'
+    if not args.tag:
+        error('Specify the tags to release with --from-tag.')
+        sys.exit(1)
+    versions = resolve_versions(args.tag)
+    if len(versions) > 1:
+        if not show_job_summary(do_release_many(args, settings, versions), release=True):
+            sys.exit(1)
+    elif versions:
+        do_release(args, settings, versions[0])
+
+@traced('phase')
+def command_versions(args, settings):
+    'Function called by the "versions" command line.  Prints the selected versions as JSON.'
+    versions = GitRepos().get_version_set()
+    try:
+        selected = versions.select(args.range, args.branch)
+    except ValueError, e:
+        error(e)
+        sys.exit(1)
+    if args.latest:
+        result = {'latest':selected[-1].tag if selected else None}
+    elif args.next_patch:
+        if args.range and '..' not in args.range:
+            branch, prefix = parse_version_pattern(args.range)
+        else:
+            branch = args.branch or GitRepos().get_current_branch()
+            latest = versions.latest(branch)
+            prefix = (latest.major, latest.minor) if latest else (0, 0)
+        prefix = (tuple(prefix) + (0, 0))[:2]
+        result = {'next':versions.next_patch(branch, *prefix).tag}
+    else:
+        result = {'versions':[v.tag for v in selected]}
+    print json.dumps(result, indent=4 if args.pretty else None)
 
+def do_find_release_branch_here(repos, remote=True):
+    'Return the commit of the release branch, preferring the one on origin (fetched first, with remote operations enabled), or None'
+    if remote:
+        # Releases are pushed from the build directory, so the local repos may not have seen them yet
+        with cd(repos.dir):
+            do('git fetch -q origin +refs/heads/%s:refs/remotes/origin/%s' % (RELEASE_BRANCH_NAME, RELEASE_BRANCH_NAME), show=False)
+    return repos.resolve('refs/remotes/origin/%s' % RELEASE_BRANCH_NAME) or repos.resolve('refs/heads/%s' % RELEASE_BRANCH_NAME)
+
+@traced('phase')
+def do_bundle_release_tree_here(settings, commit, tag):
+    '''
+    Write the bundle of a release stored as a tree on the release branch at commit, to a temporary file in the current directory.
+    Return the path to the temporary file, which the caller is expected to move into place.
+    '''
+    import shutil, tempfile
+    message('Bundling the release tree of %s' % tag)
+    tmp = tempfile.mkdtemp(prefix='.gitmake-bundle-', dir='.')
+    try:
+        rc, output = do('git archive --format=tar %s:%s | tar -x -C "%s"' % (commit, tag, tmp), show=False)
+        if rc != 0:
+            error("Couldn't read the release tree of %s: %s" % (tag, output))
+            sys.exit(1)
+        files = [(path, os.path.relpath(path, tmp).replace(os.sep, '/')) for path in walk_files(tmp)]
+        return do_write_bundle(settings, files)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def decompress_xz(fp):
+    'Decompress the xz stream in fp to a seekable file, with the xz tool if it is installed, otherwise the lzma module'
+    import shutil, subprocess, tempfile, threading
+    out = tempfile.SpooledTemporaryFile(OBJECT_SPOOL_SIZE)
+    xz = find_executable('xz')
+    if xz:
+        p = subprocess.Popen([xz, '-dc'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        def feed():
+            try:
+                shutil.copyfileobj(fp, p.stdin, HASH_CHUNK_SIZE)
+            except IOError:
+                # xz stopped reading, and its exit code says why
+                pass
+            p.stdin.close()
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+        shutil.copyfileobj(p.stdout, out, HASH_CHUNK_SIZE)
+        feeder.join()
+        if p.wait() != 0:
+            raise Exception('xz failed with error code %d' % p.returncode)
+    else:
+        try:
+            import lzma
+        except ImportError:
+            try:
+                from backports import lzma
+            except ImportError:
+                raise Exception('Reading tar.xz releases needs the xz tool or the backports.lzma module.')
+        decompressor = lzma.LZMADecompressor()
+        for chunk in iter(lambda: fp.read(HASH_CHUNK_SIZE), ''):
+            out.write(decompressor.decompress(chunk))
+    out.seek(0)
+    return out
+
+def open_release_member(reader, release, member):
+    '''
+    Open one file of a release (from the release index) through the object reader, without unpacking the others.  Zip bundles
+    are read through their central directory, tar bundles are scanned up to the file, and tree storage reads just its blob.
+    Return a tuple (file object, permission bits).  Raise KeyError if the release has no such file.
+    '''
+    import tarfile, zipfile
+    member = member.lstrip('/')
+    if member.startswith('./'):
+        member = member[2:]
+    if release['storage'] == 'tree':
+        mode, blob = reader.tree_entry(release['object'], member)
+        return reader.open(blob), int(mode, 8) & 0777
+    bundle = reader.open(release['object'])
+    if release['format'] == 'zip':
+        archive = zipfile.ZipFile(bundle)
+        info = archive.getinfo(member)
+        return archive.open(info), (info.external_attr >> 16) & 0777 or 0644
+    if release['format'] == 'tar.xz':
+        bundle = decompress_xz(bundle)
+    archive = tarfile.open(fileobj=bundle, mode='r:gz' if release['format'] == 'tar.gz' else 'r:')
+    info = archive.getmember(member)
+    if not info.isfile():
+        raise KeyError(member)
+    return archive.extractfile(info), info.mode & 0777
+
+def write_output(fp, filename, mode=0644):
+    'Copy the file object to filename (or to stdout if filename is -), replacing the file only once it is complete'
+    import shutil
+    if filename == '-':
+        shutil.copyfileobj(fp, sys.stdout, HASH_CHUNK_SIZE)
+        sys.stdout.flush()
+        return
+    with atomic_write(filename, 'wb') as out:
+        shutil.copyfileobj(fp, out, HASH_CHUNK_SIZE)
+        os.chmod(out.name, mode)
+
+@traced('phase')
+def command_bundle(args, settings):
+    'Function called by the "bundle" command line.  Writes the bundle of a release from the release branch.'
+    try:
+        version = VersionInfo.from_string(args.tag)
+    except ValueError, e:
+        error(e)
+        sys.exit(1)
+    repos = GitRepos()
+    parent = do_find_release_branch_here(repos, args.remote)
+    if not parent:
+        error('There is no release branch.')
+        sys.exit(1)
+    prefix = '%s-%s.' % (settings['release']['filename'], version.tag)
+    entries = dict((entry[3], entry) for entry in repos.read_tree(parent))
+    stored = [name for name in entries if name.startswith(prefix) and entries[name][1] == 'blob']
+    if version.tag in entries and entries[version.tag][1] == 'tree':
+        filename = args.output or prefix[:-1] + BUNDLE_FORMATS[release_format(settings)[0]]
+        os.rename(do_bundle_release_tree_here(settings, parent, version.tag), filename)
+    elif stored:
+        filename = args.output or stored[0]
+        message('Release %s is stored as the bundle %s' % (version.tag, stored[0]))
+        rc, output = do('git cat-file blob %s > "%s"' % (entries[stored[0]][2], filename), show=False)
+        if rc != 0:
+            error("Couldn't read %s: %s" % (stored[0], output))
+            sys.exit(1)
+    else:
+        error('There is no release of %s on the release branch.' % version.tag)
+        sys.exit(1)
+    os.chmod(filename, 0644)
+    message('Wrote %s' % filename)
+
+@traced('phase')
+def command_releases(args, settings):
+    '''
+    Function called by the "releases" command line.  Lists the releases, the files of a release, or gets a release or one of
+    its files, reading the git objects of the release branch without checking it out.
+    '''
+    repos = GitRepos()
+    commit = do_find_release_branch_here(repos, args.remote)
+    if not commit:
+        error('There is no release branch.')
+        sys.exit(1)
+    index = ReleaseIndex(repos, commit)
+    indent = 4 if args.pretty else None
+    if args.action == 'list' and not args.tag:
+        releases = []
+        for version in index.versions():
+            release = index.releases[version.tag]
+            releases.append(dict((k, release[k]) for k in ('storage', 'name', 'format', 'size') if k in release))
+            releases[-1]['tag'] = version.tag
+        print json.dumps({'releases':releases}, indent=indent, sort_keys=True)
+        return
+    if not args.tag:
+        error('Specify the release to get.')
+        sys.exit(1)
+    try:
+        version = VersionInfo.from_string(args.tag)
+    except ValueError, e:
+        error(e)
+        sys.exit(1)
+    release = index.releases.get(version.tag)
+    if not release:
+        error('There is no release of %s on the release branch.' % version.tag)
+        sys.exit(1)
+    if args.action == 'list' and args.member:
+        error('Use get to read a file of a release.')
+        sys.exit(1)
+    member = MANIFEST_FILENAME if args.action == 'list' else args.member
+    with ObjectReader(repos.dir) as reader:
+        if not member:
+            if release['storage'] == 'tree':
+                bundle = do_bundle_release_tree_here(settings, commit, version.tag)
+                filename = args.output or '%s-%s%s' % (settings['release']['filename'], version.tag, BUNDLE_FORMATS[release_format(settings)[0]])
+                try:
+                    with open(bundle, 'rb') as fp:
+                        write_output(fp, filename)
+                finally:
+                    os.remove(bundle)
+            else:
+                filename = args.output or release['name']
+                write_output(reader.open(release['object']), filename)
+        else:
+            try:
+                fp, mode = open_release_member(reader, release, member)
+            except KeyError:
+                error('Release %s has no file %s' % (version.tag, member))
+                sys.exit(1)
+            if args.action == 'list':
+                print json.dumps(json.load(fp), indent=indent, sort_keys=True)
+                return
+            filename = args.output or os.path.basename(member.rstrip('/'))
+            write_output(fp, filename, mode)
+    if filename != '-':
+        message('Wrote %s' % filename)
+
+@traced('phase')
 def command_deploy(args, settings):
     error('Deploy functionality not implemented yet.')
 
+@traced('phase')
 def command_clean(args, settings):
     'Function called by the "clean" command line'
     message("Running the clean command")
@@ -425,27 +2800,241 @@ def command_clean(args, settings):
     do(settings['build']['clean_command'])
     message("Cleaning complete.")
 
+@traced('phase')
 def command_update(args, settings):
-    # Fetch from releases on github (maybe use github public api)
-    # Unzip into memory
-    # Overwrite github.py
-    do_update(args.tag)
-
-def save_version_file(version_info, filename):
-    'Take the version info provided and write to file.  File format is determined from the extension of the filename given.'
-    C_TEMPLATE = '#ifndef __VERSION_H__\n#define __VERSION_H__\n#define VERSION_MAJOR $major\n#define VERSION_MINOR $minor\n#define VERSION_PATCH $patch\n#define VERSION_BRANCH $branch\n#define VERSION_TIMESTAMP $timestamp\n#endif'
-    JSON_TEMPLATE = '{"major":$major,"minor":$minor,"patch":$patch,"branch":"$branch","timestamp":$timestamp}'
-    PYTHON_TEMPLATE = 'major = $major\nminor=$minor\npatch=$patch\nbranch="$branch"\ntimestamp=$timestamp'
-    templates = {'hpp': C_TEMPLATE, 'h' : C_TEMPLATE, 'json' : JSON_TEMPLATE, 'py' : PYTHON_TEMPLATE}
+    'Function called by the "update" command line'
+    if not args.tag:
+        error('Specify the version to update to with --from-tag.')
+        sys.exit(1)
+    do_update(args.tag, args.source, args.sha256)
+
+class JobServer(object):
+    '''
+    Runs gitmake command lines sent by clients over a Unix socket.  Each job is run in a child forked from the server, so it
+    starts with gitmake already loaded and the environment checked.  Jobs on the same repos are run one at a time, at
+    most max_jobs jobs run at once, and the status and output of each job are streamed back to its client as JSON lines.
+    '''
+    def __init__(self, path, max_jobs):
+        import threading
+        self.path = path
+        self.slots = threading.BoundedSemaphore(max_jobs)
+        self.lock = threading.Lock()
+        self.repos_locks = {}
+        self.jobs = {}
+        self.next_id = 1
+        self.socket = None
+
+    def serve(self):
+        import socket
+        import threading
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(self.path)
+        self.socket.listen(64)
+        message('Serving gitmake jobs on %s' % self.path)
+        try:
+            while True:
+                conn, addr = self.socket.accept()
+                thread = threading.Thread(target=self.handle, args=(conn,))
+                thread.daemon = True
+                thread.start()
+        finally:
+            self.socket.close()
+            os.remove(self.path)
+
+    def handle(self, conn):
+        'Run the job requested on the connection, reporting back to the client'
+        import threading
+        fp = conn.makefile('rw', 0)
+        def send(msg):
+            try:
+                fp.write(json.dumps(msg) + '\n')
+            except IOError:
+                pass
+        try:
+            request = json.loads(fp.readline())
+            if request.get('status'):
+                with self.lock:
+                    send({'jobs':sorted(self.jobs.values(), key=lambda job: job['id'])})
+                return
+            with self.lock:
+                job = {'id':self.next_id, 'cwd':request['cwd'], 'argv':request['argv'], 'status':'queued'}
+                self.jobs[job['id']] = job
+                self.next_id += 1
+                key = find_git_dir(request['cwd']) or request['cwd']
+                repos_lock = self.repos_locks.setdefault(key, threading.Lock())
+            message('Job %d queued: gitmake %s in %s' % (job['id'], ' '.join(job['argv']), job['cwd']))
+            send({'job':job['id'], 'status':'queued'})
+            with repos_lock:
+                with self.slots:
+                    job['status'] = 'running'
+                    send({'job':job['id'], 'status':'running'})
+                    job['returncode'] = self.run(request, send)
+            job['status'] = 'done'
+            message('Job %d done with exit code %d' % (job['id'], job['returncode']))
+            send({'job':job['id'], 'status':'done', 'returncode':job['returncode']})
+        finally:
+            fp.close()
+            conn.close()
+
+    def run(self, request, send):
+        'Run the job in a forked child, sending its output to the client.  Return its exit code.'
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                self.socket.close()
+                os.close(r)
+                devnull = os.open(os.devnull, os.O_RDONLY)
+                os.dup2(devnull, 0)
+                os.dup2(w, 1)
+                os.dup2(w, 2)
+                sys.stdout = os.fdopen(1, 'w', 0)
+                sys.stderr = os.fdopen(2, 'w', 0)
+                os.chdir(request['cwd'])
+                os.environ.clear()
+                os.environ.update(request['env'])
+                code = run_job(request['argv'])
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        os.close(w)
+        with os.fdopen(r) as output:
+            for line in iter(output.readline, ''):
+                send({'output':line})
+        pid, status = os.waitpid(pid, 0)
+        return os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1
+
+def daemon_socket_path():
+    return os.environ.get('GITMAKE_SOCKET') or cache_directory('gitmake.sock')
+
+def connect_to_daemon(path):
+    'Return a socket connected to the gitmake daemon at path, or None if it is not running'
+    import socket
+    if not os.path.exists(path):
+        return None
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+    except socket.error:
+        s.close()
+        return None
+    return s
+
+def can_run_in_daemon(args):
+    'Return True if the command can run in the daemon, which is when it will not need to ask any questions'
+    if not getattr(args, 'daemon', False):
+        return False
+    if args.func is command_build:
+        return True
+    if args.confirm:
+        return False
+    return args.func is not command_tag or args.major or args.minor or args.patch
+
+def run_in_daemon(argv):
+    'Send the command line to the gitmake daemon, if one is running, and show its output.  Return the exit code, or None if there is no daemon.'
+    s = connect_to_daemon(daemon_socket_path())
+    if s is None:
+        return None
+    fp = s.makefile('rw', 0)
+    fp.write(json.dumps({'cwd':os.path.abspath(os.curdir), 'argv':argv, 'env':dict(os.environ)}) + '\n')
+    returncode = 1
+    for line in fp:
+        msg = json.loads(line)
+        if 'output' in msg:
+            sys.stdout.write(msg['output'])
+            sys.stdout.flush()
+        elif msg.get('status') == 'done':
+            returncode = msg['returncode']
+        else:
+            message('Job %d %s in gitmake daemon' % (msg['job'], msg['status']))
+    fp.close()
+    s.close()
+    return returncode
+
+def run_job(argv):
+    'Run a gitmake command line in this (forked daemon) process.  Return its exit code.'
+    global pending_pushes, git_process_count, tracer
+    repos_state.clear()
+    pending_pushes = []
+    tracer = None
+    git_process_count = 0
+    try:
+        arguments = parse_arguments(argv)
+        arguments.daemon = False
+        run_command_line(arguments)
+        return 0
+    except SystemExit, e:
+        return e.code if isinstance(e.code, int) else int(e.code is not None)
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        return 1
+
+@traced('phase')
+def command_serve(args, settings):
+    'Function called by the "serve" command line'
+    path = args.socket or daemon_socket_path()
+    if args.status:
+        s = connect_to_daemon(path)
+        if s is None:
+            error('No gitmake daemon is running on %s' % path)
+            sys.exit(1)
+        fp = s.makefile('rw', 0)
+        fp.write(json.dumps({'status':True}) + '\n')
+        print json.dumps(json.loads(fp.readline()), indent=4)
+        return
+    import multiprocessing
+    JobServer(path, args.max_jobs or multiprocessing.cpu_count()).serve()
+
+def version_timestamp(mode):
+    '''
+    Return the timestamp to put in a version file.  SOURCE_DATE_EPOCH is used whenever it is set, for reproducible builds.
+    Otherwise the mode is "now" for the current time, or "commit" for the time of the HEAD commit, which keeps the
+    version file the same from one build to the next.
+    '''
+    if os.environ.get('SOURCE_DATE_EPOCH'):
+        return int(os.environ['SOURCE_DATE_EPOCH'])
+    if mode not in VERSION_TIMESTAMP_MODES:
+        raise Exception('Unknown version timestamp: "%s" Valid modes are: %s' % (mode, ', '.join(VERSION_TIMESTAMP_MODES)))
+    if mode == 'commit':
+        rc, output = do('git log -1 --format=%ct', show=False)
+        if rc == 0 and output.strip():
+            return int(output)
+    return time.time()
+
+def save_version_file(version_info, filename, settings=None, timestamp='now'):
+    '''
+    Take the version info provided and write to file.  File format is determined from the extension of the filename given,
+    using VERSION_TEMPLATES and any templates in the version_templates build setting.  The timestamp mode is the
+    version_timestamp build setting, or the given default.  The file is only written (atomically) if its content changes,
+    so that builds depending on it aren't redone for nothing.  Return True if the file was written.
+    '''
+    import string
+    build_settings = (settings or {}).get('build', {})
+    templates = dict(VERSION_TEMPLATES, **build_settings.get('version_templates', {}))
     ext = os.path.splitext(filename)[1].strip().lstrip('.').lower()
     d = version_info.dict()
-    d['timestamp'] = time.time()
+    d['timestamp'] = version_timestamp(build_settings.get('version_timestamp') or timestamp)
     try:
         template = templates[ext]
-    except:
-        raise Exception('Unknown version file format: "%s" Valid formats are: %s' % (ext, templates.keys()))
-    with open(filename, 'w') as fp:    
-        fp.write(string.Template(template).substitute(d))
+    except KeyError:
+        raise Exception('Unknown version file format: "%s" Valid formats are: %s' % (ext, ', '.join(sorted(templates))))
+    content = string.Template(template).substitute(d)
+    try:
+        with open(filename) as fp:
+            if fp.read() == content:
+                return False
+    except IOError:
+        pass
+    with atomic_write(filename) as fp:
+        fp.write(content)
+    return True
 
 def initialize_environment(args):
     'Create JSON default templates for project version and settings'
@@ -487,26 +3076,53 @@ def load_settings():
         settings = {}
     return settings
 
+def find_executable(name):
+    'Return the path of the named executable on the PATH, or None'
+    for dir in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(dir, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
 def check_environment():
-    'Make sure the environment has all the prerequisites.'
+    'Make sure the environment has all the prerequisites.  A passed check is cached for the git binary (by its path and mtime).'
+    git = find_executable('git')
+    stamp = [git, os.path.getmtime(git)] if git else None
+    path = cache_directory('environment.json')
+    try:
+        with open(path) as fp:
+            if stamp and json.load(fp).get('git') == stamp:
+                return
+    except (IOError, ValueError):
+        pass
     retcode, output = do('git --version',show=False)
     if retcode != 0:
         raise Exception("Failed environment check: %s" % output)
     # TODO check here for the ability to commit and push and whatnot
+    if stamp:
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as fp:
+                json.dump({'git':stamp, 'version':output.strip()}, fp)
+        except (IOError, OSError):
+            pass
 
-def parse_arguments():
+def parse_arguments(argv=None):
     main_parser = argparse.ArgumentParser()
+    main_parser.set_defaults(needs_settings=True)
     main_parser.add_argument('--version', '-v', action='version', version=version_string)
     
     subparsers = main_parser.add_subparsers(title="Command", description="The commands for gitmake.py are:", help="Command function")
     init_parser = subparsers.add_parser('init', help='Initialize the build environment')
-    init_parser.set_defaults(func=command_init)
+    init_parser.set_defaults(func=command_init, needs_settings=False)
     
     build_parser = subparsers.add_parser('build', description='Perform a build')
     build_parser.set_defaults(func=command_build)
     group = build_parser.add_mutually_exclusive_group()
     group.add_argument('--local', action='store_true', help='Perform a build from the local source files.')
-    group.add_argument('--from-tag', type=str, metavar='TAG', dest='tag', help='Check out the specified tag and perform the build from it. (Does not modify local source)')
+    group.add_argument('--from-tag', type=str, nargs='+', metavar='TAG', dest='tag', help='Check out the specified tags (or tag patterns, such as v1.2.*-master) and perform the build from them. (Does not modify local source)')
+    build_parser.add_argument('--checkout', choices=CHECKOUT_MODES, help='How to check out the tag in the build directory. (Default is the checkout setting, or reference)')
     
     tag_parser = subparsers.add_parser('tag', help='Create a tag')
     tag_parser.set_defaults(func=command_tag)
@@ -516,11 +3132,38 @@ def parse_arguments():
     group.add_argument('--minor', dest='minor', action='store_true', default=False, help='Tag is for a minor revision')
     group.add_argument('--patch', dest='patch', action='store_true', default=False, help='Tag is for a patch revision')
     tag_parser.add_argument('--release', '-r', action='store_true', help='Perform a release after tagging.', default=False)
+    tag_parser.add_argument('--checkout', choices=CHECKOUT_MODES, help='How to check out the tag for the release. (Default is the checkout setting, or reference)')
+    group = tag_parser.add_mutually_exclusive_group()
+    group.add_argument('--pipeline', action='store_true', default=False, help='Build once, in a clean worktree of the commit to tag, and release what was built. (Implies --release)')
+    group.add_argument('--resume', action='store_true', default=False, help='Resume a --pipeline run that failed after tagging, without building again')
     
     release_parser = subparsers.add_parser('release', help='Create a release')
     release_parser.set_defaults(func=command_release)
-    release_parser.add_argument('--from-tag', type=str, metavar='TAG', dest='tag', help='Check out the specified tag and perform the release from it. (Does not modify local source)')
+    release_parser.add_argument('--from-tag', type=str, nargs='+', metavar='TAG', dest='tag', help='Check out the specified tags (or tag patterns, such as v1.2.*-master) and perform the release from them. (Does not modify local source)')
+    release_parser.add_argument('--checkout', choices=CHECKOUT_MODES, help='How to check out the tag in the build directory. (Default is the checkout setting, or reference)')
+    
+    versions_parser = subparsers.add_parser('versions', help='List tagged versions as JSON')
+    versions_parser.set_defaults(func=command_versions, quiet=True, needs_settings=False)
+    versions_parser.add_argument('--range', type=str, metavar='RANGE', help='Versions to list: a tag range A..B (inclusive), or a pattern such as v1.x-master or v1.2.*-master')
+    versions_parser.add_argument('--branch', type=str, help='Only list versions on this branch')
+    group = versions_parser.add_mutually_exclusive_group()
+    group.add_argument('--latest', action='store_true', default=False, help='Only show the latest of the selected versions')
+    group.add_argument('--next-patch', dest='next_patch', action='store_true', default=False, help='Show the next free patch version for the major.minor of the range (or the latest version on the branch)')
+    versions_parser.add_argument('--pretty', action='store_true', default=False, help='Indent the JSON output')
     
+    bundle_parser = subparsers.add_parser('bundle', help='Write the bundle of a release from the release branch')
+    bundle_parser.set_defaults(func=command_bundle)
+    bundle_parser.add_argument('--tag', type=str, required=True, metavar='TAG', help='The released version to bundle')
+    bundle_parser.add_argument('--output', '-o', type=str, metavar='FILE', help='Where to write the bundle. (Default is the bundle name in the current directory)')
+
+    releases_parser = subparsers.add_parser('releases', help='List releases, or get a release or one of its files, straight from the release branch')
+    releases_parser.set_defaults(func=command_releases, quiet=True)
+    releases_parser.add_argument('action', choices=('list', 'get'), help='list: list the releases as JSON, or the files of the release TAG.  get: write the bundle of the release TAG, or its file MEMBER.')
+    releases_parser.add_argument('tag', type=str, nargs='?', metavar='TAG', help='The released version')
+    releases_parser.add_argument('member', type=str, nargs='?', metavar='MEMBER', help='The path of a file in the release, such as bin/tool')
+    releases_parser.add_argument('--output', '-o', type=str, metavar='FILE', help='Where to write the bundle or file, or - for stdout. (Default is its name in the current directory)')
+    releases_parser.add_argument('--pretty', action='store_true', default=False, help='Indent the JSON output')
+
     deploy_parser = subparsers.add_parser('deploy', help='Deploy the build')
     deploy_parser.set_defaults(func=command_deploy)
    
@@ -528,24 +3171,64 @@ def parse_arguments():
     clean_parser.set_defaults(func=command_clean)
 
     update_parser = subparsers.add_parser('update', help='Update gitmake.py')
-    update_parser.set_defaults(func=command_update)
-    update_parser.add_argument('--from-tag', type=str, metavar='TAG', dest='tag', help='Check out the specified tag and perform the build from it. (Does not modify local source)')
+    update_parser.set_defaults(func=command_update, needs_settings=False)
+    update_parser.add_argument('--from-tag', type=str, metavar='TAG', dest='tag', help='The version of gitmake to update to.')
+    update_parser.add_argument('--source', type=str, metavar='URL', help='Where to get the update from: an http(s) or file:// URL, or a path.  $tag is replaced with the version. (Default is $GITMAKE_UPDATE_URL, or the gitmake release branch on github)')
+    update_parser.add_argument('--sha256', type=str, metavar='DIGEST', help='Expected SHA-256 digest of the update bundle')
+
+    for parser in (build_parser, release_parser):
+        parser.add_argument('--jobs', '-j', type=int, metavar='N', help='Number of tags to build in parallel when several are given. (Default is the number of CPUs)')
+    for parser in (build_parser, tag_parser, release_parser):
+        parser.add_argument('--nocache', dest='cache', action='store_false', default=True, help='Always build, without consulting the build cache')
+
+    serve_parser = subparsers.add_parser('serve', help='Run a daemon that runs build, tag and release jobs for gitmake clients')
+    serve_parser.set_defaults(func=command_serve, needs_settings=False)
+    serve_parser.add_argument('--socket', type=str, metavar='PATH', help='Unix socket to listen on. (Default is $GITMAKE_SOCKET, or ~/.cache/gitmake/gitmake.sock)')
+    serve_parser.add_argument('--max-jobs', dest='max_jobs', type=int, metavar='N', help='Maximum number of jobs to run at once. (Default is the number of CPUs)')
+    serve_parser.add_argument('--status', action='store_true', default=False, help='Print the jobs of the running daemon as JSON, instead of starting one')
+
+    for parser in (build_parser, tag_parser, release_parser):
+        parser.add_argument('--nodaemon', dest='daemon', action='store_false', default=True, help='Run here even if a gitmake daemon is running')
 
-    all_parsers = (main_parser, init_parser, build_parser, tag_parser, release_parser, deploy_parser, clean_parser)
+    all_parsers = (main_parser, init_parser, build_parser, tag_parser, release_parser, versions_parser, bundle_parser, releases_parser, deploy_parser, clean_parser, update_parser, serve_parser)
     for parser in all_parsers:
         parser.add_argument('--noconfirm', dest='confirm', action='store_false', default=True, help='Suppress any "Are you sure?" messages.')
         parser.add_argument('--noremote', dest='remote', action='store_false', default=True, help='Skip any git operations that push changes to a remote')
+        parser.add_argument('--trace', type=str, metavar='FILE', help='Write timed spans of the run to FILE, as a Chrome trace (or JSON lines if FILE ends with .jsonl)')
+        parser.add_argument('--profile', action='store_true', default=False, help='Print a table of where the time went at the end of the run')
     
-    return main_parser.parse_args()
+    return main_parser.parse_args(argv)
 
-if __name__ == "__main__":
-    arguments = parse_arguments()
-    settings = load_settings()
+def run_command_line(arguments):
+    'Run the command selected by the parsed arguments, then push everything it queued'
+    global quiet, tracer
+    quiet = getattr(arguments, 'quiet', False)
+    if arguments.trace or arguments.profile:
+        tracer = Tracer()
+    settings = load_settings() if arguments.needs_settings else {}
     check_environment()
-    arguments.func(arguments, settings)
+    try:
+        arguments.func(arguments, settings)
+        if not do_push_queued():
+            sys.exit(1)
+    finally:
+        if pending_pushes:
+            error('Not pushing %s because the command did not complete.' % ', '.join(entry[2] for entry in pending_pushes))
+        if arguments.trace:
+            tracer.write(arguments.trace)
+        if arguments.profile:
+            tracer.show_profile()
     #try:
     #    arguments.func(arguments, settings)
     #except Exception, e:
     #    error(str(e))
     #    raise e
-    message("Finished.")
+    message("Finished. (%d git processes spawned)" % git_process_count)
+
+if __name__ == "__main__":
+    arguments = parse_arguments()
+    if can_run_in_daemon(arguments):
+        returncode = run_in_daemon(sys.argv[1:])
+        if returncode is not None:
+            sys.exit(returncode)
+    run_command_line(arguments)